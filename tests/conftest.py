@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import http.server
+import logging
+import os
+import sys
+import threading
+import types
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def args(tmp_path):
+    """ Minimal args of a waydroid command, with its work dir and config
+        under tmp_path """
+    logging.verbose = logging.debug
+    work = tmp_path / "work"
+    work.mkdir()
+    return types.SimpleNamespace(
+        work=str(work), config=str(work / "waydroid.cfg"), cache={},
+        sudo_timer=False, details_to_stdout=False, timeout=30)
+
+class FileServer(http.server.ThreadingHTTPServer):
+    """ Serves files from memory with ETags and Range, If-Range and
+        If-None-Match support, and records the requests it got """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        # path: (body, etag)
+        self.files = {}
+        # (path, headers) of every request
+        self.requests = []
+        # Answer Range requests other than the first byte with an empty 206
+        self.empty_ranges = False
+        # Called with the path after each response
+        self.after = None
+
+    def url(self, path):
+        return "http://{}:{}{}".format(*self.server_address, path)
+
+    def put(self, path, body):
+        self.files[path] = (body, '"{}"'.format(hashlib.sha256(body).hexdigest()[:16]))
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *log_args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body, etag = self.server.files[self.path]
+        start, end = 0, len(body)
+        ranged = self.headers.get("Range") and \
+            self.headers.get("If-Range", etag) == etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            if ranged:
+                first, last = self.headers["Range"][len("bytes="):].split("-")
+                start, end = int(first), min(int(last) + 1, len(body))
+                if self.server.empty_ranges and self.headers["Range"] != "bytes=0-0":
+                    end = start
+            self.send_response(206 if ranged else 200)
+            self.send_header("ETag", etag)
+            if ranged:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                    start, max(start, end - 1), len(body)))
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            self.wfile.write(body[start:end])
+        if self.server.after:
+            self.server.after(self.path)
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import json
+import os
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+CHUNK = 4096
+
+def chunk(seed, length=CHUNK):
+    return hashlib.sha256(seed).digest() * (length // 32) + bytes(length % 32)
+
+@pytest.fixture
+def images(args, server, tmp_path):
+    current = tmp_path / "current.img"
+    current.write_bytes(chunk(b"a") + chunk(b"b") + chunk(b"c") + chunk(b"d"))
+    # Chunk 0 is where it was, 3 moved, 1 and 4 are new and 2 is all zero
+    new = chunk(b"a") + chunk(b"e") + bytes(CHUNK) + chunk(b"d") + chunk(b"f", 1000)
+    server.put("/system.img", new)
+    server.put("/system.json", json.dumps({
+        "image": "system.img", "url": "system.img", "size": len(new),
+        "sha256": hashlib.sha256(new).hexdigest(), "chunk_size": CHUNK,
+        "chunks": [hashlib.sha256(new[i:i + CHUNK]).hexdigest()
+                   for i in range(0, len(new), CHUNK)]}).encode())
+    dest = tmp_path / "staging"
+    dest.mkdir()
+    return str(current), new, str(dest)
+
+def ranges(server):
+    return [headers["Range"] for path, headers in server.requests if path == "/system.img"]
+
+def test_apply(args, server, images):
+    current, new, dest = images
+    build = {"chunks": server.url("/system.json")}
+    assert helpers.delta.update(args, build, current, dest)
+
+    with open(os.path.join(dest, "system.img"), "rb") as f:
+        assert f.read() == new
+    # Only the new chunks go over the network, the zero one is a hole
+    assert ranges(server) == ["bytes={}-{}".format(CHUNK, 2 * CHUNK - 1),
+                              "bytes={}-{}".format(4 * CHUNK, len(new) - 1)]
+    manifest = helpers.merkle.load(os.path.join(dest, helpers.store.MANIFEST))
+    assert manifest == helpers.merkle.build(os.path.join(dest, "system.img"), CHUNK)
+
+def test_apply_throttled(args, server, images, monkeypatch):
+    current, new, dest = images
+    consumed = []
+    monkeypatch.setattr(helpers.http.Throttle, "consume",
+                        lambda self, count: consumed.append((self.rate, count)))
+    build = {"chunks": server.url("/system.json")}
+    assert helpers.delta.update(args, build, current, dest, max_rate=1000)
+    assert sorted(consumed) == [(1000, 1000), (1000, CHUNK)]
+
+def test_apply_bad_chunk(args, server, images):
+    current, new, dest = images
+    body, etag = server.files["/system.img"]
+    server.files["/system.img"] = (body[:CHUNK] + bytes(CHUNK) + body[2 * CHUNK:], etag)
+    build = {"chunks": server.url("/system.json")}
+
+    assert not helpers.delta.update(args, build, current, dest)
+    assert os.listdir(dest) == []
+
+def test_apply_current_changed(args, server, images, monkeypatch):
+    current, new, dest = images
+    index_chunks = helpers.delta.index_chunks
+    def index_then_change(path, chunk_size):
+        index = index_chunks(path, chunk_size)
+        with open(path, "r+b") as f:
+            f.seek(3 * CHUNK)
+            f.write(chunk(b"g"))
+        return index
+    monkeypatch.setattr(helpers.delta, "index_chunks", index_then_change)
+    build = {"chunks": server.url("/system.json")}
+
+    assert not helpers.delta.update(args, build, current, dest)
+    assert ranges(server) == []
+    assert os.listdir(dest) == []
@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import json
+import os
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+DATA = os.urandom(64 * 1024 + 123)
+
+@pytest.fixture
+def cache(args):
+    os.makedirs(os.path.join(args.work, "cache_http"))
+    return args
+
+def cache_path(args, url, prefix="file"):
+    return os.path.join(args.work, "cache_http",
+                        prefix + "_" + hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+def ranges(server):
+    return [headers for _, headers in server.requests if headers.get("Range") != "bytes=0-0"]
+
+def test_segments(cache, server, monkeypatch):
+    monkeypatch.setattr(helpers.http, "MIN_SEGMENT_SIZE", 1024)
+    server.put("/file.bin", DATA)
+    path = helpers.http.download(cache, server.url("/file.bin"), "file", connections=4,
+                                 sha256=hashlib.sha256(DATA).hexdigest())
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".journal")
+    assert len(ranges(server)) == 4
+    assert all(headers["If-Range"] == server.files["/file.bin"][1] for headers in ranges(server))
+
+def test_resume(cache, server):
+    server.put("/file.bin", DATA)
+    url = server.url("/file.bin")
+    path = cache_path(cache, url)
+    half = len(DATA) // 2
+    with open(path, "wb") as f:
+        f.write(DATA[:half] + bytes(len(DATA) - half))
+    helpers.http.save_journal(path + ".journal", {
+        "url": url, "total": len(DATA), "validator": server.files["/file.bin"][1],
+        "segments": [[0, len(DATA), half]]})
+
+    assert helpers.http.download(cache, url, "file") == path
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert [headers["Range"] for headers in ranges(server)] == \
+        ["bytes={}-{}".format(half, len(DATA) - 1)]
+
+def test_resume_of_other_version(cache, server):
+    server.put("/file.bin", DATA)
+    url = server.url("/file.bin")
+    path = cache_path(cache, url)
+    with open(path, "wb") as f:
+        f.write(bytes(len(DATA)))
+    helpers.http.save_journal(path + ".journal", {
+        "url": url, "total": len(DATA), "validator": '"old"',
+        "segments": [[0, len(DATA), len(DATA) // 2]]})
+
+    helpers.http.download(cache, url, "file")
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert [headers["Range"] for headers in ranges(server)] == \
+        ["bytes=0-{}".format(len(DATA) - 1)]
+
+def test_changed_during_download(cache, server):
+    server.put("/file.bin", DATA)
+    new = DATA[::-1]
+
+    def change(path):
+        server.after = None
+        server.put("/file.bin", new)
+    server.after = change
+
+    path = helpers.http.download(cache, server.url("/file.bin"), "file",
+                                 sha256=hashlib.sha256(new).hexdigest())
+    with open(path, "rb") as f:
+        assert f.read() == new
+    # The If-Range request for the old version got the new one whole, and
+    # the download started over with a new probe
+    assert [headers.get("Range") for _, headers in server.requests] == \
+        ["bytes=0-0", "bytes=0-{}".format(len(DATA) - 1),
+         "bytes=0-0", "bytes=0-{}".format(len(DATA) - 1)]
+
+def test_empty_range_body(cache, server, monkeypatch):
+    delays = []
+    monkeypatch.setattr(helpers.http.time, "sleep", delays.append)
+    server.put("/file.bin", DATA)
+    server.empty_ranges = True
+
+    with pytest.raises(OSError):
+        helpers.http.download(cache, server.url("/file.bin"), "file")
+    assert len(ranges(server)) == helpers.http.SEGMENT_RETRIES + 1
+    assert delays == [1, 2, 4]
+    journal = json.load(open(cache_path(cache, server.url("/file.bin")) + ".journal"))
+    assert journal["segments"] == [[0, len(DATA), 0]]
+
+def test_cancel(cache, server, monkeypatch):
+    monkeypatch.setattr(helpers.http, "BLOCK_SIZE", 1024)
+    server.put("/file.bin", DATA)
+    url = server.url("/file.bin")
+    blocks = []
+    def cancel():
+        blocks.append(None)
+        return len(blocks) > 3
+
+    with pytest.raises(helpers.http.Cancelled):
+        helpers.http.download(cache, url, "file", connections=1, cancel=cancel)
+    journal = json.load(open(cache_path(cache, url) + ".journal"))
+    assert journal["segments"] == [[0, len(DATA), 3 * 1024]]
+
+    # The process that asked for it takes over where it stopped
+    server.requests.clear()
+    path = helpers.http.download(cache, url, "file", connections=1)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert [headers["Range"] for headers in ranges(server)] == \
+        ["bytes={}-{}".format(3 * 1024, len(DATA) - 1)]
+
+@pytest.fixture
+def channel(cache, server, monkeypatch):
+    monkeypatch.setattr(helpers.http, "channel_cache", {})
+    server.put("/channel.json", json.dumps({"response": [{"id": "1"}]}).encode())
+    return server.url("/channel.json")
+
+def set_ttl(args, ttl):
+    with open(args.config, "w") as f:
+        f.write("[waydroid]\nchannel_ttl = {}\n".format(ttl))
+
+def test_channel_within_ttl(cache, server, channel):
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": [{"id": "1"}]})
+    helpers.http.channel_cache.clear()
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": [{"id": "1"}]})
+    assert len(server.requests) == 1
+
+def test_channel_not_modified(cache, server, channel):
+    set_ttl(cache, 0)
+    helpers.http.retrieve_json(cache, channel)
+    # Stand in for the server answering 304: the cached body is used even
+    # though the one on the server changed
+    etag = server.files["/channel.json"][1]
+    server.files["/channel.json"] = (b"not json", etag)
+    helpers.http.channel_cache.clear()
+
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": [{"id": "1"}]})
+    assert [headers.get("If-None-Match") for _, headers in server.requests] == [None, etag]
+
+def test_channel_modified(cache, server, channel):
+    set_ttl(cache, 0)
+    helpers.http.retrieve_json(cache, channel)
+    server.put("/channel.json", json.dumps({"response": []}).encode())
+    helpers.http.channel_cache.clear()
+
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": []})
+
+def test_channel_unreachable(cache, server, channel):
+    set_ttl(cache, 0)
+    helpers.http.retrieve_json(cache, channel)
+    server.shutdown()
+    server.server_close()
+    helpers.http.pool.clear()
+    helpers.http.channel_cache.clear()
+
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": [{"id": "1"}]})
+
+def test_channel_not_json(cache, server, channel):
+    server.put("/channel.json", b"<html>captive portal</html>")
+    assert helpers.http.retrieve_json(cache, channel) == (-1, None)
+    assert not os.path.exists(helpers.http.channel_cache_path(cache, channel))
+
+    server.put("/channel.json", json.dumps({"response": []}).encode())
+    assert helpers.http.retrieve_json(cache, channel) == (200, {"response": []})
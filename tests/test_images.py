@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+def make_zip(path, data):
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("system.img", data)
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+@pytest.fixture
+def upgrade(args, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.http, "channel_cache", {})
+    images_zip = str(tmp_path / "system.zip")
+    digest = make_zip(images_zip, os.urandom(10000))
+    server.put("/system.json", json.dumps({"response": [{"id": digest}]}).encode())
+    with open(args.config, "w") as f:
+        f.write("[waydroid]\nsystem_ota = {}\nimages_path = {}\n".format(
+            server.url("/system.json"), tmp_path / "images"))
+    hashed = []
+    sha256sum = helpers.images.sha256sum
+    def counting(filename):
+        hashed.append(filename)
+        return sha256sum(filename)
+    monkeypatch.setattr(helpers.images, "sha256sum", counting)
+    return images_zip, digest, hashed
+
+def test_stage_validated(args, upgrade):
+    images_zip, digest, hashed = upgrade
+    validated = {images_zip: helpers.images.validate(args, "system_ota", images_zip)}
+    assert validated[images_zip]["sha256"] == digest
+
+    staged = helpers.images.stage(args, images_zip, 1, "", 0, validated)
+    assert [(kind, build["id"]) for kind, build in staged] == [("system", digest)]
+    assert hashed == [images_zip]
+    assert helpers.store.has(args, "system", digest)
+
+def test_stage_rewritten(args, upgrade):
+    images_zip, digest, hashed = upgrade
+    validated = {images_zip: helpers.images.validate(args, "system_ota", images_zip)}
+    # Same size and mtime, other content
+    st = os.stat(images_zip)
+    other = make_zip(images_zip + ".new", os.urandom(10000))
+    with open(images_zip + ".new", "rb") as f, open(images_zip, "r+b") as dest:
+        dest.write(f.read())
+    os.utime(images_zip, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    staged = helpers.images.stage(args, images_zip, 1, "", 0, validated)
+    assert [build["id"] for _, build in staged] == [other]
+    assert hashed == [images_zip, images_zip]
+
+def test_validate_unknown(args, upgrade):
+    images_zip, digest, hashed = upgrade
+    make_zip(images_zip, b"other")
+    assert helpers.images.validate(args, "system_ota", images_zip) is None
+
+def test_locked_asks_to_yield(args):
+    def wait():
+        with helpers.store.locked(args, "system", "abc") as acquired:
+            assert acquired
+
+    with helpers.store.locked(args, "system", "abc", wait=False) as acquired:
+        assert acquired
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        while not helpers.store.yield_requested(args, "system", "abc"):
+            time.sleep(0.01)
+    waiter.join()
+    assert not helpers.store.yield_requested(args, "system", "abc")
@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+@pytest.fixture
+def run_dir(monkeypatch):
+    # Reachable by other users, unlike tmp_path
+    path = tempfile.mkdtemp()
+    os.chmod(path, 0o755)
+    monkeypatch.setattr(helpers.ipc, "BASE_DIR", path + "/")
+    yield path
+    shutil.rmtree(path)
+
+def connect(name):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.connect(helpers.ipc.socket_for(name))
+    return sock
+
+def subscribe_as(name, uid):
+    """ Connect from a child process running as uid.
+
+        :returns: the first message the child got, or b"closed" if the
+                  channel closed the connection """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            os.setuid(uid)
+            sock = connect(name)
+            sock.settimeout(5)
+            os.write(write, helpers.ipc.recv_message(sock) or b"closed")
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read, "rb") as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return data
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root to switch uid")
+@pytest.mark.parametrize("uids, expected", [((), b"closed"), ((65534,), b"hello")])
+def test_subscriber_uid(run_dir, uids, expected):
+    channel = helpers.ipc.Channel("test", uids=uids)
+    try:
+        result = []
+        child = threading.Thread(target=lambda: result.append(subscribe_as("test", 65534)))
+        child.start()
+        deadline = 50
+        while child.is_alive() and deadline:
+            channel.publish("hello")
+            child.join(0.1)
+            deadline -= 1
+        assert result == [expected]
+    finally:
+        channel.close()
+
+def test_publish(run_dir):
+    channel = helpers.ipc.Channel("test")
+    try:
+        with helpers.ipc.open_channel("test") as subscription:
+            assert channel.wait_subscriber(1)
+            # Larger than a packet and than the socket buffer
+            received = []
+            reader = threading.Thread(target=lambda: received.append(subscription.recv()))
+            reader.start()
+            assert channel.publish("x" * 300000) == 1
+            reader.join()
+            assert received == [b"x" * 300000]
+    finally:
+        channel.close()
+
+def test_stale_backlog(run_dir):
+    channel = helpers.ipc.Channel("test")
+    try:
+        connect("test").close()
+        assert not channel.wait_subscriber(0.1)
+        assert channel.subscribers == []
+    finally:
+        channel.close()
+
+def test_discard_pending(run_dir):
+    parent = helpers.ipc.Channel("test")
+    try:
+        late = connect("test")
+        parent.discard_pending()
+        # A worker on the same listener doesn't get the late subscriber
+        worker = helpers.ipc.Channel("test", parent.listener)
+        assert not worker.wait_subscriber(0.1)
+        assert late.recv(16) == b""
+        late.close()
+    finally:
+        parent.close()
+
+class FakeContainerManager:
+    def __init__(self, session):
+        self.session = session
+        self.frozen = False
+
+    def GetSessionState(self, unfreeze):
+        return self.session
+
+    def Freeze(self):
+        self.frozen = True
+
+@pytest.mark.parametrize("session, frozen", [({"state": "FROZEN"}, True),
+                                             ({"state": "RUNNING"}, False)])
+def test_unfrozen_session(monkeypatch, session, frozen):
+    cm = FakeContainerManager(session)
+    monkeypatch.setattr(helpers.ipc, "session_running", lambda: True)
+    monkeypatch.setattr(helpers.ipc, "DBusContainerService", lambda: cm)
+    with helpers.ipc.unfrozen_session() as state:
+        assert state == session
+    assert cm.frozen == frozen
+
+def test_unfrozen_session_stopped(monkeypatch):
+    monkeypatch.setattr(helpers.ipc, "session_running", lambda: True)
+    monkeypatch.setattr(helpers.ipc, "DBusContainerService", lambda: FakeContainerManager({}))
+    ran = []
+    with pytest.raises(KeyError):
+        with helpers.ipc.unfrozen_session():
+            ran.append(True)
+    assert not ran
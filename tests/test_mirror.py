@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import http.client
+import http.server
+import os
+import threading
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+ID = "ab" * 32
+DATA = bytes(range(256)) * 4
+
+@pytest.fixture
+def mirror(args):
+    with open(args.config, "w") as f:
+        f.write("[waydroid]\nsystem_ota = http://127.0.0.1:9/system.json\n"
+                "vendor_ota = http://127.0.0.1:9/vendor.json\n")
+    entry = os.path.join(args.work, "store", "system", ID)
+    os.makedirs(entry)
+    for name in ("system.img", helpers.store.KEPT_ZIP):
+        with open(os.path.join(entry, name), "wb") as f:
+            f.write(DATA)
+
+    handler = type("Handler", (helpers.mirror.MirrorHandler,), {"args": args})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def get(address, headers={}):
+    conn = http.client.HTTPConnection(*address, timeout=10)
+    conn.request("GET", "/files/system/{}/{}".format(ID, helpers.store.KEPT_ZIP), headers=headers)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+def test_whole_file(mirror):
+    response, body = get(mirror)
+    assert response.status == 200
+    assert response.getheader("Content-Range") is None
+    assert body == DATA
+
+@pytest.mark.parametrize("spec, start, end", [
+    ("bytes=0-9", 0, 10),
+    ("bytes=1000-", 1000, len(DATA)),
+    ("bytes=1000-5000", 1000, len(DATA)),
+    ("bytes=-24", len(DATA) - 24, len(DATA)),
+])
+def test_range(mirror, spec, start, end):
+    response, body = get(mirror, {"Range": spec})
+    assert response.status == 206
+    assert response.getheader("Content-Range") == "bytes {}-{}/{}".format(start, end - 1, len(DATA))
+    assert body == DATA[start:end]
+
+@pytest.mark.parametrize("spec", ["bytes=-", "bytes=-0", "bytes=5000-", "bytes=9-3"])
+def test_unsatisfiable_range(mirror, spec):
+    response, body = get(mirror, {"Range": spec})
+    assert response.status == 416
+    assert response.getheader("Content-Range") == "bytes */{}".format(len(DATA))
+    assert body == b""
+
+def test_unknown_file(mirror):
+    conn = http.client.HTTPConnection(*mirror, timeout=10)
+    conn.request("GET", "/files/system/{}/other.zip".format("cd" * 32))
+    assert conn.getresponse().status == 404
+    conn.close()
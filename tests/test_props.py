@@ -0,0 +1,38 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+SESSION = {"user_name": "None", "user_id": "None", "group_id": "None",
+           "waydroid_data": "None", "background_start": "false", "lcd_density": "320"}
+
+def make_prop(args, base):
+    with open(os.path.join(args.work, "waydroid_base.prop"), "w") as f:
+        f.write(base)
+    path = os.path.join(args.work, "waydroid.prop")
+    helpers.images.make_prop(args, SESSION, path)
+    with open(path) as f:
+        return helpers.props.parse(f.read())
+
+def test_session_props(args):
+    props = make_prop(args, "ro.hardware.gralloc=gbm\n")
+    assert props["ro.hardware.gralloc"] == "gbm"
+    assert props["ro.sf.lcd_density"] == "320"
+    assert props["waydroid.background_start"] == "false"
+
+def test_base_keeps_read_only_props(args):
+    # [properties] from waydroid.cfg end up in the base file
+    props = make_prop(args, "ro.sf.lcd_density=240\nwaydroid.background_start=true\n")
+    assert props["ro.sf.lcd_density"] == "240"
+    assert props["waydroid.background_start"] == "false"
+
+def test_layers():
+    layers = helpers.props.Layers()
+    layers.add("host", {"ro.hardware.egl": "mesa", "a": "1"})
+    layers.add("config", {"ro.hardware.egl": "swiftshader"})
+    layers.add("session", {"ro.hardware.egl": "other", "a": "2"}, keep_ro=True)
+    assert layers.render() == "ro.hardware.egl=swiftshader\na=2\n"
@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import errno
+import os
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from tools import helpers
+
+DATA = os.urandom(100000) + bytes(300000) + os.urandom(1000)
+
+@pytest.fixture
+def legacy(args, tmp_path, monkeypatch):
+    images_path = tmp_path / "images"
+    images_path.mkdir()
+    (images_path / "system.img").write_bytes(DATA)
+    # images_path is on another filesystem than the store
+    rename = os.rename
+    def cross_device(src, dest):
+        if os.path.dirname(src) == str(images_path):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        rename(src, dest)
+    monkeypatch.setattr(os, "rename", cross_device)
+    return str(images_path)
+
+def test_adopt_across_filesystems(args, legacy):
+    helpers.store.adopt(args, "system", legacy, 1234)
+
+    link = os.path.join(legacy, "system.img")
+    assert helpers.store.active(args, "system", legacy) == "legacy-1234"
+    with open(link, "rb") as f:
+        assert f.read() == DATA
+    image = helpers.store.image_path(args, "system", "legacy-1234")
+    assert os.stat(image).st_blocks * 512 < len(DATA)
+    assert helpers.merkle.load(helpers.store.manifest_path(args, "system", "legacy-1234")) == \
+        helpers.merkle.build(image)
+
+def test_adopt_failed_copy(args, legacy, monkeypatch):
+    def fail(src, dest):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    monkeypatch.setattr(helpers.store, "copy_sparse", fail)
+
+    with pytest.raises(OSError):
+        helpers.store.adopt(args, "system", legacy, 1234)
+    path = os.path.join(legacy, "system.img")
+    assert not os.path.islink(path)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert helpers.store.entries(args, "system") == []
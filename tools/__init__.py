@@ -46,7 +46,7 @@ def main():
         dbus_name_scope = None
 
         if not actions.initializer.is_initialized(args) and \
-                args.action and args.action not in ("init", "first-launch", "log"):
+                args.action and args.action not in ("init", "first-launch", "log", "bundle"):
             if args.wait_for_init:
                 try:
                     dbus_name_scope = dbus.service.BusName("id.waydro.Container", dbus.SystemBus(), do_not_queue=True)
@@ -65,6 +65,28 @@ def main():
         elif args.action == "upgrade":
             actionNeedRoot(args.action)
             actions.upgrade(args)
+        elif args.action == "images":
+            if args.subaction == "verify":
+                actions.image_manager.verify(args)
+            else:
+                logging.info(
+                    "Run waydroid {} -h for usage information.".format(args.action))
+        elif args.action == "bundle":
+            actionNeedRoot(args.action)
+            if args.subaction == "create":
+                helpers.bundle.create(args, args.path)
+            elif args.subaction == "import":
+                helpers.bundle.install(args, args.path, args.digest)
+            else:
+                logging.info(
+                    "Run waydroid {} -h for usage information.".format(args.action))
+        elif args.action == "mirror":
+            actionNeedRoot(args.action)
+            if args.subaction == "serve":
+                helpers.mirror.serve(args, args.address, args.port)
+            else:
+                logging.info(
+                    "Run waydroid {} -h for usage information.".format(args.action))
         elif args.action == "session":
             if args.subaction == "start":
                 actions.session_manager.start(args)
@@ -87,10 +109,17 @@ def main():
                 actions.container_manager.stop(args)
             elif args.subaction == "restart":
                 actions.container_manager.restart(args)
+            # Through the service when it runs, so it knows the new state
             elif args.subaction == "freeze":
-                actions.container_manager.freeze(args)
+                if helpers.ipc.container_running():
+                    helpers.ipc.DBusContainerService().Freeze()
+                else:
+                    actions.container_manager.freeze(args)
             elif args.subaction == "unfreeze":
-                actions.container_manager.unfreeze(args)
+                if helpers.ipc.container_running():
+                    helpers.ipc.DBusContainerService().Unfreeze()
+                else:
+                    actions.container_manager.unfreeze(args)
             else:
                 logging.info(
                     "Run waydroid {} -h for usage information.".format(args.action))
@@ -113,6 +142,9 @@ def main():
                 actions.prop.get(args)
             elif args.subaction == "set":
                 actions.prop.set(args)
+            elif args.subaction == "dump":
+                actionNeedRoot(args.action)
+                actions.prop.dump(args)
             else:
                 logging.info(
                     "Run waydroid {} -h for usage information.".format(args.action))
@@ -129,7 +161,10 @@ def main():
             if actions.initializer.is_initialized(args):
                 actions.app_manager.showFullUI(args)
         elif args.action == "status":
-            actions.status.print_status(args)
+            if args.watch:
+                actions.status.watch(args)
+            else:
+                actions.status.print_status(args)
         elif args.action == "log":
             if args.clear_log:
                 helpers.run.user(args, ["truncate", "-s", "0", args.log])
@@ -13,61 +13,50 @@ import dbus
 
 def install(args):
     try:
-        tools.helpers.ipc.DBusSessionService()
-
-        cm = tools.helpers.ipc.DBusContainerService()
-        session = cm.GetSession()
-        if session["state"] == "FROZEN":
-            cm.Unfreeze()
-
-        tmp_dir = tools.config.session_defaults["waydroid_data"] + "/waydroid_tmp"
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-
-        shutil.copyfile(args.PACKAGE, tmp_dir + "/base.apk")
-        platformService = IPlatform.get_service(args)
-        if platformService:
-            platformService.installApp("/data/waydroid_tmp/base.apk")
-        else:
-            logging.error("Failed to access IPlatform service")
-        os.remove(tmp_dir + "/base.apk")
-
-        if session["state"] == "FROZEN":
-            cm.Freeze()
+        with tools.helpers.ipc.unfrozen_session():
+            tmp_dir = tools.config.session_defaults["waydroid_data"] + "/waydroid_tmp"
+            if not os.path.exists(tmp_dir):
+                os.makedirs(tmp_dir)
+
+            shutil.copyfile(args.PACKAGE, tmp_dir + "/base.apk")
+            platformService = IPlatform.get_service(args)
+            if platformService:
+                platformService.installApp("/data/waydroid_tmp/base.apk")
+            else:
+                logging.error("Failed to access IPlatform service")
+            os.remove(tmp_dir + "/base.apk")
     except (dbus.DBusException, KeyError):
         logging.error("WayDroid session is stopped")
 
 def remove(args):
     try:
-        tools.helpers.ipc.DBusSessionService()
-
-        cm = tools.helpers.ipc.DBusContainerService()
-        session = cm.GetSession()
-        if session["state"] == "FROZEN":
-            cm.Unfreeze()
-
-        platformService = IPlatform.get_service(args)
-        if platformService:
-            ret = platformService.removeApp(args.PACKAGE)
-            if ret != 0:
-                logging.error("Failed to uninstall package: {}".format(args.PACKAGE))
-        else:
-            logging.error("Failed to access IPlatform service")
+        with tools.helpers.ipc.unfrozen_session():
+            platformService = IPlatform.get_service(args)
+            if platformService:
+                ret = platformService.removeApp(args.PACKAGE)
+                if ret != 0:
+                    logging.error("Failed to uninstall package: {}".format(args.PACKAGE))
+            else:
+                logging.error("Failed to access IPlatform service")
+    except (dbus.DBusException, KeyError):
+        logging.error("WayDroid session is stopped")
 
-        if session["state"] == "FROZEN":
-            cm.Freeze()
+def setActiveApps(platformService, active_apps):
+    platformService.setprop("waydroid.active_apps", active_apps)
+    # Let the container manager pick the matching resource profile
+    try:
+        tools.helpers.ipc.DBusContainerService().SetActiveApps(active_apps)
     except dbus.DBusException:
-        logging.error("WayDroid session is stopped")
+        pass
 
 def maybeLaunchLater(args, launchNow):
-    try:
-        tools.helpers.ipc.DBusSessionService()
+    if tools.helpers.ipc.session_running():
         try:
             tools.helpers.ipc.DBusContainerService().Unfreeze()
         except:
             logging.error("Failed to unfreeze container. Trying to launch anyways...")
         launchNow()
-    except dbus.DBusException:
+    else:
         logging.error("Starting waydroid session")
         tools.actions.session_manager.start(args, launchNow, background=False)
 
@@ -75,7 +64,7 @@ def launch(args):
     def justLaunch():
         platformService = IPlatform.get_service(args)
         if platformService:
-            platformService.setprop("waydroid.active_apps", args.PACKAGE)
+            setActiveApps(platformService, args.PACKAGE)
             ret = platformService.launchApp(args.PACKAGE)
             multiwin = platformService.getprop(
                 "persist.waydroid.multi_windows", "false")
@@ -91,35 +80,26 @@ def launch(args):
 
 def list(args):
     try:
-        tools.helpers.ipc.DBusSessionService()
-
-        cm = tools.helpers.ipc.DBusContainerService()
-        session = cm.GetSession()
-        if session["state"] == "FROZEN":
-            cm.Unfreeze()
-
-        platformService = IPlatform.get_service(args)
-        if platformService:
-            appsList = platformService.getAppsInfo()
-            for app in appsList:
-                print("Name: " + app["name"])
-                print("packageName: " + app["packageName"])
-                print("categories:")
-                for cat in app["categories"]:
-                    print("\t" + cat)
-        else:
-            logging.error("Failed to access IPlatform service")
-
-        if session["state"] == "FROZEN":
-            cm.Freeze()
-    except dbus.DBusException:
+        with tools.helpers.ipc.unfrozen_session():
+            platformService = IPlatform.get_service(args)
+            if platformService:
+                appsList = platformService.getAppsInfo()
+                for app in appsList:
+                    print("Name: " + app["name"])
+                    print("packageName: " + app["packageName"])
+                    print("categories:")
+                    for cat in app["categories"]:
+                        print("\t" + cat)
+            else:
+                logging.error("Failed to access IPlatform service")
+    except (dbus.DBusException, KeyError):
         logging.error("WayDroid session is stopped")
 
 def showFullUI(args):
     def justShow():
         platformService = IPlatform.get_service(args)
         if platformService:
-            platformService.setprop("waydroid.active_apps", "Waydroid")
+            setActiveApps(platformService, "Waydroid")
             platformService.settingsPutString(2, "policy_control", "null*")
             # HACK: Refresh display contents
             statusBarService = IStatusBarService.get_service(args)
@@ -139,7 +119,7 @@ def intent(args):
             if ret == "":
                 return
             pkg = ret if ret != "android" else "Waydroid"
-            platformService.setprop("waydroid.active_apps", pkg)
+            setActiveApps(platformService, pkg)
             multiwin = platformService.getprop(
                 "persist.waydroid.multi_windows", "false")
             if multiwin == "false":
@@ -5,6 +5,7 @@ import logging
 import os
 import glob
 import signal
+import time
 import tools.config
 from tools import helpers
 from tools import services
@@ -13,11 +14,14 @@ import dbus.service
 import dbus.exceptions
 from gi.repository import GLib
 
+INTERFACE = "id.waydro.ContainerManager"
+
 class DbusContainerManager(dbus.service.Object):
     def __init__(self, looper, bus, object_path, args):
         self.args = args
         self.looper = looper
         dbus.service.Object.__init__(self, bus, object_path)
+        args.dbus_container_manager = self
 
     @dbus.service.method("id.waydro.ContainerManager", in_signature='a{ss}', out_signature='', sender_keyword="sender", connection_keyword="conn")
     def Start(self, session, sender, conn):
@@ -42,15 +46,89 @@ class DbusContainerManager(dbus.service.Object):
     def Unfreeze(self):
         unfreeze(self.args)
 
+    @dbus.service.method("id.waydro.ContainerManager", in_signature='s', out_signature='')
+    def SetActiveApps(self, active_apps):
+        set_active_apps(self.args, active_apps)
+
     @dbus.service.method("id.waydro.ContainerManager", in_signature='', out_signature='a{ss}')
     def GetSession(self):
         try:
             session = self.args.session
             session["state"] = helpers.lxc.status(self.args)
+            # Also catches changes made behind our back, e.g. lxc-freeze
+            set_state(self.args, session["state"])
             return session
         except AttributeError:
             return {}
 
+    @dbus.service.method("id.waydro.ContainerManager", in_signature='b', out_signature='a{ss}')
+    def GetSessionState(self, thaw):
+        # GetSession and Unfreeze in one call, the state is the one before
+        session = self.GetSession()
+        if thaw and session.get("state") == "FROZEN":
+            unfreeze(self.args)
+        return session
+
+    @dbus.service.method("id.waydro.ContainerManager", in_signature='', out_signature='', sender_keyword="sender", connection_keyword="conn")
+    def NotifyBootCompleted(self, sender, conn):
+        # Called by the session once Android unlocked its user
+        dbus_info = dbus.Interface(conn.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus/Bus", False), "org.freedesktop.DBus")
+        uid = dbus_info.GetConnectionUnixUser(sender)
+        if "session" not in self.args or str(uid) not in ["0", self.args.session["user_id"]]:
+            raise RuntimeError("Not the owner of the session")
+        self.BootCompleted()
+
+    @dbus.service.signal("id.waydro.ContainerManager", signature='ss')
+    def StateChanged(self, old, new):
+        pass
+
+    @dbus.service.signal("id.waydro.ContainerManager", signature='a{ss}')
+    def SessionStarted(self, session):
+        pass
+
+    @dbus.service.signal("id.waydro.ContainerManager", signature='')
+    def SessionStopped(self):
+        pass
+
+    @dbus.service.signal("id.waydro.ContainerManager", signature='')
+    def BootCompleted(self):
+        pass
+
+    # State is cached from the transitions below, reading it forks nothing
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, prop):
+        props = self.GetAll(interface)
+        if prop not in props:
+            raise dbus.exceptions.DBusException(
+                "No such property: " + prop, name="org.freedesktop.DBus.Error.UnknownProperty")
+        return props[prop]
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != INTERFACE:
+            raise dbus.exceptions.DBusException(
+                "No such interface: " + interface, name="org.freedesktop.DBus.Error.UnknownInterface")
+        return {"State": getattr(self.args, "container_state", "STOPPED")}
+
+    @dbus.service.signal(dbus.PROPERTIES_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+def emit(args, signal, *params):
+    """ Send a signal of the DBus object from the main loop, so that any
+        thread may call this """
+    obj = getattr(args, "dbus_container_manager", None)
+    if obj is not None:
+        GLib.idle_add(getattr(obj, signal), *params)
+
+def set_state(args, state):
+    """ Record a container state transition and announce it """
+    old = getattr(args, "container_state", "STOPPED")
+    args.container_state = state
+    if state != old:
+        emit(args, "StateChanged", old, state)
+        emit(args, "PropertiesChanged", INTERFACE, {"State": state}, [])
+
 def service(args, looper):
     dbus_obj = DbusContainerManager(looper, dbus.SystemBus(), '/ContainerManager', args)
     looper.run()
@@ -119,11 +197,14 @@ def start(args):
         mainloop = GLib.MainLoop()
 
         def sigint_handler(data):
+            services.upgrade_stager.stop(args)
             stop(args)
             mainloop.quit()
 
         GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, sigint_handler, None)
         GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, sigint_handler, None)
+        services.upgrade_stager.start(args)
+        set_state(args, status)
         service(args, mainloop)
     else:
         logging.error("WayDroid container is {}".format(status))
@@ -137,7 +218,10 @@ def do_start(args, session):
         from . import modular_container_manager
         manager = modular_container_manager.ModularContainerManager(args)
         manager.args.session = session
-        return manager.run_all_steps()
+        ret = manager.run_all_steps()
+        set_state(args, helpers.lxc.status(args))
+        emit(args, "SessionStarted", session)
+        return ret
 
     # Networking
     command = [tools.config.tools_src +
@@ -194,20 +278,26 @@ def do_start(args, session):
     helpers.protocol.set_aidl_version(args)
 
     helpers.lxc.start(args)
-    
+    helpers.cgroup.apply_profile(args, "active")
+    services.memory_governor.start(args)
+
     # Hardware manager is now optional - can be started separately via modular approach
     # services.hardware_manager.start(args)
 
     args.session = session
+    set_state(args, "RUNNING")
+    emit(args, "SessionStarted", session)
 
 def stop(args, quit_session=True):
     try:
         services.hardware_manager.stop(args)
+        services.memory_governor.stop(args)
         status = helpers.lxc.status(args)
         if status != "STOPPED":
             helpers.lxc.stop(args)
             while helpers.lxc.status(args) != "STOPPED":
                 pass
+        set_state(args, "STOPPED")
 
         # Networking
         command = [tools.config.tools_src +
@@ -230,6 +320,11 @@ def stop(args, quit_session=True):
                 command = ["kill", "-9", pid]
                 tools.helpers.run.user(args, command, check=False)
 
+        helpers.cgroup.forget(args)
+        for attr in ["active_apps", "frozen_by_governor"]:
+            if attr in args:
+                delattr(args, attr)
+
         # Umount rootfs
         helpers.images.umount_rootfs(args)
 
@@ -246,6 +341,7 @@ def stop(args, quit_session=True):
                 except:
                     pass
             del args.session
+            emit(args, "SessionStopped")
     except:
         pass
 
@@ -253,7 +349,9 @@ def restart(args):
     status = helpers.lxc.status(args)
     if status == "RUNNING":
         helpers.lxc.stop(args)
+        set_state(args, "STOPPED")
         helpers.lxc.start(args)
+        set_state(args, "RUNNING")
     else:
         logging.error("WayDroid container is {}".format(status))
 
@@ -263,12 +361,34 @@ def freeze(args):
         helpers.lxc.freeze(args)
         while helpers.lxc.status(args) == "RUNNING":
             pass
+        set_state(args, "FROZEN")
+        helpers.cgroup.apply_profile(args, "background")
+        helpers.cgroup.reclaim(args)
     else:
         logging.error("WayDroid container is {}".format(status))
 
 def unfreeze(args):
+    if "frozen_by_governor" in args:
+        del args.frozen_by_governor
     status = helpers.lxc.status(args)
     if status == "FROZEN":
+        start = time.monotonic()
+        helpers.cgroup.apply_profile(args, active_profile(args))
         helpers.lxc.unfreeze(args)
         while helpers.lxc.status(args) == "FROZEN":
             pass
+        set_state(args, "RUNNING")
+        if "reclaimed" in args:
+            del args.reclaimed
+            logging.info("Thawed reclaimed container in {:.0f}ms".format(
+                (time.monotonic() - start) * 1000))
+
+def active_profile(args):
+    # Android without visible apps only needs background resources
+    return "active" if getattr(args, "active_apps", "") else "background"
+
+def set_active_apps(args, active_apps):
+    """ Track the apps Android shows, "" once it has none left """
+    args.active_apps = active_apps
+    if helpers.lxc.status(args) == "RUNNING":
+        helpers.cgroup.apply_profile(args, active_profile(args))
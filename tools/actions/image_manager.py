@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import time
+import tools.config
+from tools import helpers
+
+def verify(args):
+    """ Check the active images against the chunk manifests in the image
+        store, hashing on every core. An image without a manifest fails:
+        one made now would only vouch for whatever is there already. """
+    cfg = tools.config.load(args)
+    images_path = cfg["waydroid"]["images_path"]
+    failed = []
+    for kind in helpers.store.KINDS:
+        image = os.path.join(images_path, kind + ".img")
+        id = helpers.store.active(args, kind, images_path)
+        if id is None:
+            print("{}:\tnot in the image store, nothing to verify against".format(kind))
+            continue
+
+        try:
+            helpers.store.check(args, kind, id)
+        except ValueError as e:
+            print("{}:\t{}".format(kind, e))
+            failed.append(kind)
+            continue
+
+        manifest = helpers.merkle.load(helpers.store.manifest_path(args, kind, id))
+        if manifest is None:
+            print("{}:\tno manifest for image {}".format(kind, id))
+            failed.append(kind)
+            continue
+
+        size = os.path.getsize(image)
+        reporter = helpers.progress.Reporter("verify", size, kind + ".img")
+        start = time.monotonic()
+        bad = helpers.merkle.verify(image, manifest, reporter=reporter)
+        reporter.finish()
+        elapsed = max(time.monotonic() - start, 0.001)
+
+        if bad:
+            print("{}:\t{} of {} chunks don't match, first at offset {}".format(
+                kind, len(bad), len(manifest["chunks"]), bad[0] * manifest["chunk_size"]))
+            failed.append(kind)
+        else:
+            print("{}:\tOK, {} MB in {:.1f}s ({:.0f} MB/s), root {}".format(
+                kind, size // 1000000, elapsed, size / elapsed / 1000000, manifest["root"]))
+
+    if failed:
+        raise RuntimeError("Verification failed for: " + ", ".join(failed))
@@ -7,14 +7,17 @@ import tools.config
 
 import sys
 import threading
+import concurrent.futures
 import multiprocessing
-import select
 import queue
 import time
 import dbus
 import dbus.service
 from gi.repository import GLib
 
+# Seconds the remote init worker waits for the client that asked for it
+SUBSCRIBE_TIMEOUT = 60
+
 def is_initialized(args):
     return os.path.isfile(args.config) and os.path.isdir(tools.config.defaults["rootfs"])
 
@@ -111,7 +114,7 @@ def setup_config(args):
     # Always use "lineage" in the URL - the server contains all versions
     args.system_ota = args.system_channel + "/" + args.rom_type + \
         "/waydroid_" + args.arch + "/" + args.system_type + ".json"
-    system_request = helpers.http.retrieve(args.system_ota)
+    system_request = helpers.bundle.retrieve_channel(args, args.system_ota)
     if system_request[0] != 200:
         raise ValueError(
             "Failed to get system OTA channel: {}, error: {}".format(args.system_ota, system_request[0]))
@@ -123,7 +126,7 @@ def setup_config(args):
         # Use the specified vendor type directly
         vendor_ota = args.vendor_channel + "/waydroid_" + \
             args.arch + "/" + args.vendor_type.replace(" ", "_") + ".json"
-        vendor_request = helpers.http.retrieve(vendor_ota)
+        vendor_request = helpers.bundle.retrieve_channel(args, vendor_ota)
         if vendor_request[0] == 200:
             args.vendor_ota = vendor_ota
         else:
@@ -133,14 +136,21 @@ def setup_config(args):
         # Auto-detect vendor type
         device_codename = helpers.props.host_get(args, "ro.product.device")
         args.vendor_type = None
+        candidates = []
         for vendor in [device_codename, get_vendor_type(args)]:
             vendor_ota = args.vendor_channel + "/waydroid_" + \
                 args.arch + "/" + vendor.replace(" ", "_") + ".json"
-            vendor_request = helpers.http.retrieve(vendor_ota)
-            if vendor_request[0] == 200:
-                args.vendor_type = vendor
-                args.vendor_ota = vendor_ota
-                break
+            candidates.append((vendor, vendor_ota))
+
+        # Probe every candidate at once, but keep the first one that exists
+        with concurrent.futures.ThreadPoolExecutor(len(candidates)) as pool:
+            requests = [pool.submit(helpers.bundle.retrieve_channel, args, vendor_ota)
+                        for _, vendor_ota in candidates]
+            for (vendor, vendor_ota), request in zip(candidates, requests):
+                if request.result()[0] == 200:
+                    args.vendor_type = vendor
+                    args.vendor_ota = vendor_ota
+                    break
 
         if not args.vendor_type:
             raise ValueError(
@@ -214,19 +224,22 @@ def init(args):
         logging.info("Already initialized")
 
 def wait_for_init(args):
-    helpers.ipc.create_channel("remote_init_output")
+    # Listen before anyone can ask for init, clients subscribe right after
+    channel = helpers.ipc.create_channel("remote_init_output")
 
     mainloop = GLib.MainLoop()
-    dbus_obj = DbusInitializer(mainloop, dbus.SystemBus(), '/Initializer', args)
+    dbus_obj = DbusInitializer(mainloop, dbus.SystemBus(), '/Initializer', args, channel)
     mainloop.run()
 
     # After init
     dbus_obj.remove_from_connection()
+    channel.close()
 
 class DbusInitializer(dbus.service.Object):
-    def __init__(self, looper, bus, object_path, args):
+    def __init__(self, looper, bus, object_path, args, channel):
         self.args = args
         self.looper = looper
+        self.channel = channel
         dbus.service.Object.__init__(self, bus, object_path)
 
     @dbus.service.method("id.waydro.Initializer", in_signature='a{ss}', out_signature='', sender_keyword="sender", connection_keyword="conn")
@@ -235,7 +248,9 @@ class DbusInitializer(dbus.service.Object):
         no_auth = params["system_channel"] == channels_cfg["channels"]["system_channel"] and \
                   params["vendor_channel"] == channels_cfg["channels"]["vendor_channel"]
         if no_auth or ensure_polkit_auth(sender, conn, "id.waydro.Initializer.Init"):
-            threading.Thread(target=remote_init_server, args=(self.args, params)).start()
+            # Only the caller gets to read the output
+            uid = bus_info(conn).GetConnectionUnixUser(sender)
+            threading.Thread(target=remote_init_server, args=(self.args, params, self, uid)).start()
         else:
             raise PermissionError("Polkit: Authentication failed")
 
@@ -244,9 +259,15 @@ class DbusInitializer(dbus.service.Object):
         if is_initialized(self.args):
             self.looper.quit()
 
+    @dbus.service.signal("id.waydro.Initializer", signature='ssttdd')
+    def Progress(self, phase, name, done, total, rate, eta):
+        pass
+
+def bus_info(conn):
+    return dbus.Interface(conn.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus/Bus", False), "org.freedesktop.DBus")
+
 def ensure_polkit_auth(sender, conn, privilege):
-    dbus_info = dbus.Interface(conn.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus/Bus", False), "org.freedesktop.DBus")
-    pid = dbus_info.GetConnectionUnixProcessID(sender)
+    pid = bus_info(conn).GetConnectionUnixProcessID(sender)
     polkit = dbus.Interface(dbus.SystemBus().get_object("org.freedesktop.PolicyKit1", "/org/freedesktop/PolicyKit1/Authority", False), "org.freedesktop.PolicyKit1.Authority")
     try:
         (is_auth, _, _) = polkit.CheckAuthorization(
@@ -261,55 +282,71 @@ def ensure_polkit_auth(sender, conn, privilege):
     except dbus.DBusException:
         raise PermissionError("Polkit: Authentication timed out")
 
-def background_remote_init_process(args):
-    with helpers.ipc.open_channel("remote_init_output", "wb") as channel_out:
-        class StdoutRedirect(logging.StreamHandler):
-            def write(self, s):
-                channel_out.write(str.encode(s))
-            def flush(self):
-                pass
-            def emit(self, record):
-                if record.levelno >= logging.INFO:
-                    self.write(self.format(record) + self.terminator)
-
-        out = StdoutRedirect()
-        sys.stdout = sys.stderr = out
-        logging.getLogger().addHandler(out)
-
-        ctl_queue = queue.Queue()
-        def try_init(args):
-            try:
-                init(args)
-            except Exception as e:
-                print(str(e))
-            finally:
-                ctl_queue.put(0)
-
-        def poll_pipe():
-            poller = select.poll()
-            poller.register(channel_out, select.POLLERR)
-            poller.poll()
-            # When reaching here the client was terminated
-            ctl_queue.put(0)
-
-        init_thread = threading.Thread(target=try_init, args=(args,))
-        init_thread.daemon = True
-        init_thread.start()
+def background_remote_init_process(args, listener, uid, progress_events):
+    helpers.progress.subscribe(progress_events.put)
+    channel_out = helpers.ipc.Channel("remote_init_output", listener, [uid])
+    # Like the FIFO this replaces, start once the client is reading
+    if not channel_out.wait_subscriber(SUBSCRIBE_TIMEOUT):
+        logging.error("Nobody read the output of the remote init, giving up")
+        channel_out.close()
+        return
 
-        poll_thread = threading.Thread(target=poll_pipe)
-        poll_thread.daemon = True
-        poll_thread.start()
+    class StdoutRedirect(logging.StreamHandler):
+        def write(self, s):
+            channel_out.publish(s)
+        def flush(self):
+            pass
+        def emit(self, record):
+            if record.levelno >= logging.INFO:
+                self.write(self.format(record) + self.terminator)
 
-        # Join any one of the two threads
-        # Then exit the subprocess to kill the remaining thread.
-        # Can you believe this is the only way to kill a thread in python???
-        ctl_queue.get()
+    out = StdoutRedirect()
+    sys.stdout = sys.stderr = out
+    logging.getLogger().addHandler(out)
 
-        sys.stdout = sys.__stdout__
-        sys.stderr = sys.__stderr__
-        logging.getLogger().removeHandler(out)
+    ctl_queue = queue.Queue()
+    def try_init(args):
+        try:
+            init(args)
+        except Exception as e:
+            print(str(e))
+        finally:
+            ctl_queue.put(0)
 
-def remote_init_server(args, params):
+    def poll_pipe():
+        channel_out.wait_idle()
+        # When reaching here the client was terminated
+        ctl_queue.put(0)
+
+    init_thread = threading.Thread(target=try_init, args=(args,))
+    init_thread.daemon = True
+    init_thread.start()
+
+    poll_thread = threading.Thread(target=poll_pipe)
+    poll_thread.daemon = True
+    poll_thread.start()
+
+    # Join any one of the two threads
+    # Then exit the subprocess to kill the remaining thread.
+    # Can you believe this is the only way to kill a thread in python???
+    ctl_queue.get()
+
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    logging.getLogger().removeHandler(out)
+    channel_out.close()
+
+def relay_progress(progress_events, initializer):
+    # Runs in the service process, which owns the bus connection
+    while True:
+        event = progress_events.get()
+        if event is None:
+            break
+        GLib.idle_add(initializer.Progress, event["phase"], event["name"],
+                      dbus.UInt64(event["bytes"]), dbus.UInt64(event["total"]),
+                      event["rate"], event["eta"])
+
+def remote_init_server(args, params, initializer, uid):
     args.force = True
     args.images_path = ""
     args.rom_type = ""
@@ -321,10 +358,20 @@ def remote_init_server(args, params):
     args.no_gpu = params.get("no_gpu", None) == "true"
     args.running_init_in_service = True
 
-    p = multiprocessing.Process(target=background_remote_init_process, args=(args,))
+    progress_events = multiprocessing.Queue()
+    relay = threading.Thread(target=relay_progress, args=(progress_events, initializer))
+    relay.daemon = True
+    relay.start()
+
+    p = multiprocessing.Process(target=background_remote_init_process,
+                                args=(args, initializer.channel.listener, uid, progress_events))
     p.daemon = True
     p.start()
     p.join()
+    # Whoever subscribed after the worker stopped accepting was too late
+    # for this run, don't hand them to the next one
+    initializer.channel.discard_pending()
+    progress_events.put(None)
 
 def remote_init_client(args):
     # Local imports cause Gtk is intrusive
@@ -422,6 +469,12 @@ def remote_init_client(args):
             grid.attach_next_to(doneBtn, downloadBtn, Gtk.PositionType.RIGHT, 1, 1)
             self.doneBtn = doneBtn
 
+            progressBar = Gtk.ProgressBar(show_text=True)
+            grid.attach(progressBar, 0, 8, 3, 1)
+            self.progressBar = progressBar
+            bus.add_signal_receiver(self.on_progress, signal_name="Progress",
+                                    dbus_interface="id.waydro.Initializer")
+
             outScrolledWindow = Gtk.ScrolledWindow()
             outScrolledWindow.set_hexpand(True)
             outScrolledWindow.set_vexpand(True)
@@ -435,7 +488,17 @@ def remote_init_client(args):
             self.outBuffer = outTextView.get_buffer()
             self.outBuffer.create_mark("end", self.outBuffer.get_end_iter(), False)
 
-            self.open_channel = None
+            self.subscription = None
+
+        def on_progress(self, phase, name, done, total, rate, eta):
+            label = {"download": "Downloading", "verify": "Verifying",
+                     "extract": "Extracting"}.get(phase, phase)
+            text = "{} {}: {:.0f} MB/{:.0f} MB".format(label, name, done / 1000000, total / 1000000)
+            if eta:
+                text += ", {:.0f}s left".format(eta)
+            self.progressBar.set_text(text)
+            self.progressBar.set_fraction(done / total if total else 0)
+            self.progressBar.show()
 
         def scroll_to_bottom(self):
             self.outTextView.scroll_mark_onscreen(self.outBuffer.get_mark("end"))
@@ -464,8 +527,10 @@ def remote_init_client(args):
             def draw(s):
                 GLib.idle_add(draw_sync, s)
 
-            if self.open_channel is not None:
-                self.open_channel.close()
+            if self.subscription is not None:
+                self.subscription.close()
+                self.subscription = None
+                draw("\nInterrupted\n")
                 # Wait for other end to reset
                 time.sleep(1)
 
@@ -490,31 +555,37 @@ def remote_init_client(args):
                 GLib.idle_add(self.downloadBtn.set_sensitive, True)
                 return
 
-            with helpers.ipc.open_channel("remote_init_output", "rb") as channel:
-                self.open_channel = channel
+            try:
+                subscription = helpers.ipc.open_channel("remote_init_output")
+            except OSError:
+                draw("The waydroid container service is not listening\n")
                 GLib.idle_add(self.downloadBtn.set_sensitive, True)
-                line = ""
-                try:
-                    while True:
-                        data = channel.read(1)
-                        if len(data) == 0:
-                            draw(line)
-                            break
-                        c = data.decode()
-                        if c == '\r':
-                            draw(line)
-                            line = c
-                        else:
-                            line += c
-                            if c == '\n':
-                                draw(line)
-                                line = ""
-                except:
-                    draw("\nInterrupted\n")
-
-            if is_initialized(args):
-                GLib.idle_add(self.doneBtn.show)
-                draw("Done\n")
+                return
+            self.subscription = subscription
+            GLib.idle_add(self.downloadBtn.set_sensitive, True)
+
+            line = ""
+            def on_output(data):
+                # Runs on the main loop, once per message
+                nonlocal line
+                if data is None:
+                    draw_sync(line)
+                    self.subscription = None
+                    subscription.close()
+                    if is_initialized(args):
+                        self.doneBtn.show()
+                        draw_sync("Done\n")
+                    return
+                for c in data.decode(errors="replace"):
+                    if c == '\r':
+                        draw_sync(line)
+                        line = c
+                    else:
+                        line += c
+                        if c == '\n':
+                            draw_sync(line)
+                            line = ""
+            subscription.watch(on_output)
 
 
     GLib.set_prgname("Waydroid")
@@ -522,6 +593,7 @@ def remote_init_client(args):
     win.connect("destroy", notify_and_quit)
 
     win.show_all()
+    win.progressBar.hide()
     win.outTextView.hide()
     win.doneBtn.hide()
 
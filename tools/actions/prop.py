@@ -1,38 +1,62 @@
+import json
 import logging
+import time
 import tools.helpers.props
 import tools.helpers.ipc
 import dbus
 
+def parse_assignments(items):
+    """ Accept both "prop set KEY VALUE" and "prop set KEY=VALUE...". """
+    if len(items) == 2 and "=" not in items[0]:
+        return {items[0]: items[1]}
+    props = {}
+    for item in items:
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise ValueError("Expected KEY=VALUE, got: " + item)
+        props[key] = value
+    return props
+
+def print_props(args, props):
+    if args.json:
+        print(json.dumps(props, indent=4))
+    elif len(props) == 1 and args.subaction == "get":
+        for value in props.values():
+            if value:
+                print(value)
+    else:
+        for key, value in props.items():
+            print("{}={}".format(key, value))
+
 def get(args):
     try:
-        tools.helpers.ipc.DBusSessionService()
-
-        cm = tools.helpers.ipc.DBusContainerService()
-        session = cm.GetSession()
-        if session["state"] == "FROZEN":
-            cm.Unfreeze()
-
-        ret = tools.helpers.props.get(args, args.key)
-        if ret:
-            print(ret)
-
-        if session["state"] == "FROZEN":
-            cm.Freeze()
+        with tools.helpers.ipc.unfrozen_session():
+            start = time.monotonic()
+            props = tools.helpers.props.get_many(args, args.key)
+            logging.debug("Read {} properties in {:.1f} ms".format(
+                len(args.key), (time.monotonic() - start) * 1000))
+        if props is not None:
+            print_props(args, props)
     except (dbus.DBusException, KeyError):
         logging.error("WayDroid session is stopped")
 
 def set(args):
+    props = parse_assignments(args.key)
     try:
-        tools.helpers.ipc.DBusSessionService()
-
-        cm = tools.helpers.ipc.DBusContainerService()
-        session = cm.GetSession()
-        if session["state"] == "FROZEN":
-            cm.Unfreeze()
-
-        tools.helpers.props.set(args, args.key, args.value)
+        with tools.helpers.ipc.unfrozen_session():
+            start = time.monotonic()
+            done = tools.helpers.props.set_many(args, props)
+            logging.debug("Set {} properties in {:.1f} ms".format(
+                len(props), (time.monotonic() - start) * 1000))
+        if done and args.json:
+            print(json.dumps(props, indent=4))
+    except (dbus.DBusException, KeyError):
+        logging.error("WayDroid session is stopped")
 
-        if session["state"] == "FROZEN":
-            cm.Freeze()
+def dump(args):
+    try:
+        with tools.helpers.ipc.unfrozen_session():
+            props = tools.helpers.props.dump(args, args.prefix)
+        print_props(args, props)
     except (dbus.DBusException, KeyError):
         logging.error("WayDroid session is stopped")
@@ -1,9 +1,12 @@
 # Copyright 2021 Erfan Abdi
 # SPDX-License-Identifier: GPL-3.0-or-later
+import signal
+import time
 import tools.config
 import tools.helpers.ipc
 import tools.helpers.net
 import dbus
+from gi.repository import GLib
 
 def print_status(args):
     cfg = tools.config.load(args)
@@ -24,3 +27,29 @@ def print_status(args):
             print_stopped()
     except dbus.DBusException:
         print_stopped()
+
+def watch(args):
+    print_status(args)
+
+    def show(key, value):
+        print("[{}] {}:\t{}".format(time.strftime("%H:%M:%S"), key, value), flush=True)
+
+    def on_signal(*params, member=None):
+        if member == "StateChanged":
+            show("Container", params[1])
+        elif member == "SessionStarted":
+            show("Session", "RUNNING")
+        elif member == "SessionStopped":
+            show("Session", "STOPPED")
+        elif member == "BootCompleted":
+            show("Android", "BOOTED")
+
+    # Follows the container service across restarts, nothing is polled
+    dbus.SystemBus().add_signal_receiver(
+        on_signal, dbus_interface="id.waydro.ContainerManager",
+        bus_name="id.waydro.Container", path="/ContainerManager",
+        member_keyword="member")
+
+    mainloop = GLib.MainLoop()
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, lambda data: mainloop.quit(), None)
+    mainloop.run()
@@ -49,7 +49,10 @@ def upgrade(args):
             tools.actions.container_manager.stop(args)
     migration(args)
     helpers.drivers.loadBinderNodes(args)
-    if not args.offline:
+    if args.rollback:
+        if helpers.store.rollback(args, args.images_path):
+            helpers.images.remove_overlay(args)
+    elif not args.offline:
         if args.images_path not in tools.config.defaults["preinstalled_images_paths"]:
             helpers.images.get(args)
         else:
@@ -25,7 +25,15 @@ config_keys = ["arch",
                "mount_overlays",
                "auto_adb",
                "android_version",
-               "no_gpu"]
+               "no_gpu",
+               "gpu_policy",
+               "store_versions",
+               "store_budget_mb",
+               "store_keep_zips",
+               "channel_ttl",
+               "prestage",
+               "prestage_interval",
+               "prestage_max_rate_kb"]
 
 # Config file/commandline default values
 # $WORK gets replaced with the actual value for args.work (which may be
@@ -43,6 +51,14 @@ defaults = {
     "suspend_action": "freeze",
     "mount_overlays": "True",
     "auto_adb": "True",
+    "gpu_policy": "auto",
+    "store_versions": "2",
+    "store_budget_mb": "0",
+    "store_keep_zips": "False",
+    "channel_ttl": "300",
+    "prestage": "False",
+    "prestage_interval": "21600",
+    "prestage_max_rate_kb": "2048",
     "container_xdg_runtime_dir": "/run/xdg",
     "container_wayland_display": "wayland-0",
 }
@@ -75,6 +91,32 @@ session_defaults["waydroid_data"] = session_defaults["xdg_data_home"] + \
 if session_defaults["pulse_runtime_path"] == "None":
     session_defaults["pulse_runtime_path"] = session_defaults["xdg_runtime_dir"] + "/pulse"
 
+# Container resource policy, saved in the [resources] section of the config.
+# Every "<profile>_<file>" key is written to the matching cgroup v2 interface
+# file of the container when that profile becomes active.
+resources_defaults = {
+    "enabled": "True",
+    "active_cpu_weight": "100",
+    "active_io_weight": "100",
+    "active_memory_high": "max",
+    "active_memory_max": "max",
+    "background_cpu_weight": "20",
+    "background_io_weight": "20",
+    "background_memory_high": "max",
+    "background_memory_max": "max",
+    # Push the memory of a frozen container to swap right after freezing
+    "freeze_reclaim": "False",
+    "freeze_reclaim_high": "64M",
+    # Memory pressure governor: escalate after psi_escalate_after PSI events
+    # (more than psi_stall_us stalled within psi_window_us), and step back
+    # down after psi_recover_s seconds without one
+    "psi_enabled": "True",
+    "psi_stall_us": "150000",
+    "psi_window_us": "1000000",
+    "psi_escalate_after": "3",
+    "psi_recover_s": "30",
+}
+
 channels_defaults = {
     "config_path": "/usr/share/waydroid-extra/channels.cfg",
     "system_channel": "https://ota.waydro.id/system",
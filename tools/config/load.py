@@ -30,6 +30,12 @@ def load(args):
         cfg["properties"] = {}
     # no default values for property override
 
+    if "resources" not in cfg:
+        cfg["resources"] = {}
+    for key, value in tools.config.resources_defaults.items():
+        if key not in cfg["resources"]:
+            cfg["resources"][key] = value
+
     return cfg
 
 def load_channels():
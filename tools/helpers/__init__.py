@@ -7,8 +7,15 @@ import tools.helpers.lxc
 import tools.helpers.images
 import tools.helpers.drivers
 import tools.helpers.mount
+import tools.helpers.progress
 import tools.helpers.http
+import tools.helpers.delta
+import tools.helpers.merkle
+import tools.helpers.store
+import tools.helpers.bundle
+import tools.helpers.mirror
 import tools.helpers.ipc
 import tools.helpers.gpu
+import tools.helpers.cgroup
 import tools.helpers.protocol
 import tools.helpers.version
@@ -44,12 +44,48 @@ def arguments_init(subparser):
 def arguments_status(subparser):
     ret = subparser.add_parser("status",
                                help="quick check for the waydroid")
+    ret.add_argument("--watch", action="store_true",
+                     help="keep running and print state changes as they happen")
     return ret
 
 def arguments_upgrade(subparser):
     ret = subparser.add_parser("upgrade", help="upgrade images")
     ret.add_argument("-o", "--offline", action="store_true",
                      help="just for updating configs")
+    ret.add_argument("-r", "--rollback", action="store_true",
+                     help="switch back to the previously used images without"
+                          " downloading anything")
+    return ret
+
+def arguments_images(subparser):
+    ret = subparser.add_parser("images", help="manage the installed images")
+    sub = ret.add_subparsers(title="subaction", dest="subaction")
+    sub.add_parser("verify", help="check the active images against their"
+                                  " chunk manifests")
+    return ret
+
+def arguments_bundle(subparser):
+    ret = subparser.add_parser("bundle", help="offline provisioning bundles")
+    sub = ret.add_subparsers(title="subaction", dest="subaction")
+    create = sub.add_parser("create", help="pack the active images into a bundle")
+    create.add_argument("path", help="bundle file to write")
+    install = sub.add_parser("import", help="verify a bundle and add its images"
+                                            " to the image store")
+    install.add_argument("-d", "--digest", required=True,
+                         help="sha256 of the bundle, as printed by bundle create")
+    install.add_argument("path", help="bundle file to read")
+    return ret
+
+def arguments_mirror(subparser):
+    ret = subparser.add_parser("mirror", help="share the image store with"
+                               " other machines")
+    sub = ret.add_subparsers(title="subaction", dest="subaction")
+    serve = sub.add_parser("serve", help="serve the channels and kept image"
+                                         " zips over HTTP")
+    serve.add_argument("-a", "--address", default="0.0.0.0",
+                       help="address to listen on (default: all)")
+    serve.add_argument("-p", "--port", type=int, default=8080,
+                       help="port to listen on (default: 8080)")
     return ret
 
 def arguments_log(subparser):
@@ -98,12 +134,22 @@ def arguments_prop(subparser):
     ret = subparser.add_parser("prop", help="android properties controller")
     sub = ret.add_subparsers(title="subaction", dest="subaction")
     get = sub.add_parser(
-        "get", help="get value of property from container")
-    get.add_argument('key', help="key of the property to get")
+        "get", help="get value of properties from container")
+    get.add_argument('key', nargs='+', help="keys of the properties to get")
+    get.add_argument("-j", "--json", action="store_true",
+                     help="print a JSON object")
     set = sub.add_parser(
-        "set", help="set value to property on container")
-    set.add_argument('key', help="key of the property to set")
-    set.add_argument('value', help="value of the property to set")
+        "set", help="set value to properties on container")
+    set.add_argument('key', nargs='+', metavar="KEY=VALUE",
+                     help="properties to set, or a single KEY VALUE")
+    set.add_argument("-j", "--json", action="store_true",
+                     help="print what was set as a JSON object")
+    dump = sub.add_parser(
+        "dump", help="list all properties of the container")
+    dump.add_argument("-p", "--prefix", default="",
+                      help="only list properties starting with this")
+    dump.add_argument("-j", "--json", action="store_true",
+                      help="print a JSON object")
     return ret
 
 def arguments_fullUI(subparser):
@@ -158,6 +204,9 @@ def arguments():
     arguments_log(sub)
     arguments_init(sub)
     arguments_upgrade(sub)
+    arguments_images(sub)
+    arguments_bundle(sub)
+    arguments_mirror(sub)
     arguments_session(sub)
     arguments_container(sub)
     arguments_app(sub)
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import zipfile
+import tools.config
+from tools import helpers
+
+# Offline provisioning bundles.
+#
+# A bundle is a zip with the active images of a machine, to install
+# waydroid on others without downloading them again:
+#
+#     bundle.json             what is inside, see below
+#     <kind>/<kind>.img       the image, deflated so empty blocks cost
+#                             next to nothing
+#     <kind>/merkle.json      its chunk manifest, see tools.helpers.merkle
+#
+# bundle.json holds, for each kind, the OTA channel URL ("ota"), the
+# channel entry of the build ("build") and the Merkle root of the image
+# ("root"). Creating a bundle prints the sha256 of bundle.json, which has
+# to be given to the import: it is the only thing not taken from the
+# bundle itself, and it pins the roots, the manifests and through them
+# every chunk of the images. Importing checks all of that without
+# network access and puts the images in the image store. The bundled
+# builds are recorded apart from the channel cache, so that waydroid init
+# or waydroid upgrade on the same channels can pick them from the store;
+# image validation never trusts that record. The OTA URLs are left as
+# they are, later online upgrades work as usual.
+
+BUNDLE_VERSION = 1
+# Deflate quickly, images are mostly empty space or already compressed data
+COMPRESS_LEVEL = 1
+BLOCK_SIZE = 1024 * 1024
+# Builds imported from bundles, by OTA channel URL, in args.work
+SEEDED_BUILDS = "bundle_builds.json"
+
+def channel_build(args, ota, id):
+    """ :returns: the entry of build id on the channel at ota, or None """
+    if ota == "None":
+        return None
+    request = helpers.http.retrieve_json(args, ota)
+    if request[0] != 200:
+        return None
+    for build in request[1]["response"]:
+        if build["id"] == id:
+            return build
+    return None
+
+def create(args, path):
+    cfg = tools.config.load(args)
+    images_path = cfg["waydroid"]["images_path"]
+    bundle = {"version": BUNDLE_VERSION, "created": int(time.time()),
+              "arch": cfg["waydroid"]["arch"], "images": {}}
+
+    tmp_path = path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=COMPRESS_LEVEL, allowZip64=True) as zip_ref:
+        for kind in helpers.store.KINDS:
+            id = helpers.store.active(args, kind, images_path)
+            if id is None:
+                raise ValueError("The {} image is not in the image store, bundles"
+                                 " can only be made after waydroid upgrade".format(kind))
+            image = helpers.store.image_path(args, kind, id)
+
+            # Only bundle what still matches its manifest
+            helpers.store.check(args, kind, id)
+            manifest = helpers.merkle.load(helpers.store.manifest_path(args, kind, id))
+            if manifest is None:
+                manifest = helpers.merkle.build(image)
+            elif helpers.merkle.verify(image, manifest):
+                raise ValueError("{} image {} in the store is corrupted".format(kind, id))
+
+            ota = cfg["waydroid"][kind + "_ota"]
+            meta = helpers.store.read_meta(args, kind, id)
+            build = channel_build(args, ota, id) or {
+                "id": id, "datetime": meta["datetime"], "filename": meta.get("filename", "")}
+            bundle["images"][kind] = {"ota": ota, "build": build, "root": manifest["root"],
+                                      "size": manifest["size"],
+                                      "chunk_size": manifest["chunk_size"]}
+
+            logging.info("Adding {} image {}".format(kind, id))
+            reporter = helpers.progress.Reporter("bundle", os.path.getsize(image), kind + ".img")
+            with open(image, "rb") as src, \
+                    zip_ref.open(kind + "/" + kind + ".img", "w", force_zip64=True) as dst:
+                for block in iter(lambda: src.read(BLOCK_SIZE), b""):
+                    dst.write(block)
+                    reporter.advance(len(block))
+            reporter.finish()
+            zip_ref.writestr(kind + "/" + helpers.store.MANIFEST, json.dumps(manifest))
+        document = json.dumps(bundle, indent=4).encode("utf-8")
+        zip_ref.writestr("bundle.json", document)
+    os.replace(tmp_path, path)
+    logging.info("Created bundle " + path)
+    logging.info("Bundle digest: " + hashlib.sha256(document).hexdigest())
+    logging.info("Import it with: waydroid bundle import --digest {} {}".format(
+        hashlib.sha256(document).hexdigest(), os.path.basename(path)))
+
+def load_seeded(args):
+    try:
+        with open(os.path.join(args.work, SEEDED_BUILDS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def seed_channel(args, ota, kind, build):
+    """ Record build as available for the channel at ota """
+    if ota == "None":
+        return
+    seeded = load_seeded(args)
+    entries = [e for e in seeded.get(ota, []) if e["build"]["id"] != build["id"]]
+    seeded[ota] = entries + [{"kind": kind, "build": build}]
+    path = os.path.join(args.work, SEEDED_BUILDS)
+    with open(path + ".tmp", "w") as f:
+        json.dump(seeded, f)
+    os.replace(path + ".tmp", path)
+
+def retrieve_channel(args, ota):
+    """ Like helpers.http.retrieve_json for an OTA channel, with the builds
+        imported from bundles that are still in the image store added. Only
+        for picking builds, validate images against the real channel. """
+    request = helpers.http.retrieve_json(args, ota)
+    seeded = [entry["build"] for entry in load_seeded(args).get(ota, [])
+              if helpers.store.has(args, entry["kind"], entry["build"]["id"])]
+    if not seeded:
+        return request
+    builds = request[1]["response"] if request[0] == 200 else []
+    known = {build["id"] for build in builds}
+    builds = builds + [build for build in seeded if build["id"] not in known]
+    builds.sort(key=lambda build: build["datetime"], reverse=True)
+    return 200, {"response": builds}
+
+def install(args, path, digest):
+    """ :param digest: sha256 of bundle.json, as printed by create() """
+    with zipfile.ZipFile(path) as zip_ref:
+        document = zip_ref.read("bundle.json")
+        if hashlib.sha256(document).hexdigest() != digest.lower():
+            raise ValueError("Bundle digest doesn't match, expected: " + digest)
+        bundle = json.loads(document)
+        if bundle.get("version") != BUNDLE_VERSION:
+            raise ValueError("Unsupported bundle version: {}".format(bundle.get("version")))
+        if os.path.isfile(args.config):
+            arch = tools.config.load(args)["waydroid"]["arch"]
+            if bundle["arch"] != arch:
+                raise ValueError("Bundle is for {}, not {}".format(bundle["arch"], arch))
+
+        for kind, entry in bundle["images"].items():
+            if kind not in helpers.store.KINDS:
+                raise ValueError("Unknown image kind in bundle: " + kind)
+            build = entry["build"]
+            manifest = json.loads(zip_ref.read(kind + "/" + helpers.store.MANIFEST))
+            # The root alone doesn't tell leaves from inner nodes, the
+            # layout has to match too
+            count = -(-entry["size"] // entry["chunk_size"])
+            if helpers.merkle.root(manifest["chunks"]) != entry["root"] or \
+                    manifest["size"] != entry["size"] or \
+                    manifest["chunk_size"] != entry["chunk_size"] or \
+                    len(manifest["chunks"]) != count:
+                raise ValueError("Manifest of the {} image doesn't match the bundle".format(kind))
+
+            with helpers.store.locked(args, kind, build["id"]):
+                if helpers.store.has(args, kind, build["id"]):
+                    logging.info("{} image {} is already in the store".format(kind, build["id"]))
+                else:
+                    logging.info("Importing {} image {}".format(kind, build["id"]))
+                    staging = helpers.store.staging_dir(args, kind, build["id"])
+                    image = os.path.join(staging, kind + ".img")
+                    extracted = helpers.images.extract_member(
+                        zip_ref, zip_ref.getinfo(kind + "/" + kind + ".img"), image)
+                    if extracted["chunks"] != manifest["chunks"] or \
+                            extracted["size"] != manifest["size"]:
+                        bad = next((i for i, (a, b) in enumerate(zip(extracted["chunks"], manifest["chunks"]))
+                                    if a != b), min(len(extracted["chunks"]), len(manifest["chunks"])))
+                        shutil.rmtree(staging)
+                        raise ValueError("{} image in the bundle is corrupted at offset {}".format(
+                            kind, bad * manifest["chunk_size"]))
+                    helpers.store.commit(args, kind, build, staging, manifest)
+            seed_channel(args, entry["ota"], kind, build)
+
+    logging.info("Imported bundle {}, run 'waydroid init' (or 'waydroid upgrade' if"
+                 " already initialized) with the channels of {} and {}".format(
+                     path, bundle["images"]["system"]["ota"], bundle["images"]["vendor"]["ota"]))
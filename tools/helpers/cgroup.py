@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import errno
+import logging
+import os
+import time
+import tools.config
+import tools.helpers.run
+
+CGROUP2_ROOT = "/sys/fs/cgroup"
+
+# Interface files written for a resource profile, in this order. memory.high
+# goes before memory.max so shrinking a profile throttles before it OOMs.
+PROFILE_FILES = ["cpu.weight", "io.weight", "memory.high", "memory.max"]
+
+def container_path(args):
+    """ Find the cgroup v2 directory of the running container.
+
+        The path is resolved once through the container init process and
+        kept in args.cgroup_path until the container is stopped.
+
+        :returns: absolute path in /sys/fs/cgroup, or None when the container
+                  is not running or the host does not use cgroup v2 """
+    path = getattr(args, "cgroup_path", None)
+    if path and os.path.isdir(path):
+        return path
+
+    command = ["lxc-info", "-P", tools.config.defaults["lxc"], "-n", "waydroid", "-pH"]
+    try:
+        pid = tools.helpers.run.user(args, command, output_return=True, check=False).strip()
+        with open("/proc/{}/cgroup".format(int(pid))) as f:
+            for line in f:
+                hierarchy, _, rel_path = line.strip().split(":", 2)
+                if hierarchy == "0":
+                    path = CGROUP2_ROOT + rel_path
+                    break
+            else:
+                path = None
+    except (ValueError, OSError):
+        path = None
+
+    if path is None or not os.path.isfile(path + "/cgroup.controllers"):
+        logging.debug("Couldn't find cgroup v2 directory of the container")
+        return None
+    args.cgroup_path = path
+    return path
+
+def forget(args):
+    """ Drop cached cgroup state, to be called when the container stops. """
+    for attr in ["cgroup_path", "resource_profile", "reclaimed"]:
+        if attr in args:
+            delattr(args, attr)
+
+def read(path, key):
+    try:
+        with open(os.path.join(path, key)) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def write(path, key, value):
+    try:
+        with open(os.path.join(path, key), "w") as f:
+            f.write(str(value))
+        return True
+    except OSError as e:
+        logging.debug("Failed to set {} to {}: {}".format(key, value, e))
+        return False
+
+def profile_values(cfg, profile):
+    values = {}
+    for key in PROFILE_FILES:
+        cfg_key = profile + "_" + key.replace(".", "_")
+        values[key] = cfg["resources"].get(cfg_key, "")
+    return values
+
+def apply_profile(args, profile):
+    """ Apply the "active" or "background" resource profile from the
+        [resources] section of waydroid.cfg to the container cgroup. """
+    if getattr(args, "resource_profile", None) == profile:
+        return
+    cfg = tools.config.load(args)
+    if cfg["resources"]["enabled"] != "True":
+        return
+    path = container_path(args)
+    if not path:
+        return
+
+    for key, value in profile_values(cfg, profile).items():
+        if value:
+            write(path, key, value)
+    args.resource_profile = profile
+    logging.info("Applied {} resource profile".format(profile))
+
+def memory_usage(path):
+    """ :returns: (memory.current, memory.swap.current) in bytes """
+    def to_int(value):
+        try:
+            return int(value)
+        except ValueError:
+            return 0
+    return to_int(read(path, "memory.current")), to_int(read(path, "memory.swap.current"))
+
+def reclaim(args):
+    """ Push the memory of a frozen container out to swap or zram.
+
+        memory.reclaim is used where the kernel has it (5.19+). Older kernels
+        reclaim synchronously when memory.high is lowered, so memory.high is
+        shrunk to freeze_reclaim_high for a moment instead. """
+    cfg = tools.config.load(args)
+    if cfg["resources"]["freeze_reclaim"] != "True":
+        return
+    path = container_path(args)
+    if not path:
+        return
+
+    before, swap_before = memory_usage(path)
+    start = time.monotonic()
+    try:
+        with open(path + "/memory.reclaim", "w") as f:
+            f.write(str(before))
+    except OSError as e:
+        # EAGAIN only means less than requested could be reclaimed
+        if e.errno != errno.EAGAIN:
+            logging.debug("memory.reclaim failed: {}, shrinking memory.high".format(e))
+            high = read(path, "memory.high")
+            if write(path, "memory.high", cfg["resources"]["freeze_reclaim_high"]):
+                write(path, "memory.high", high)
+    after, swap_after = memory_usage(path)
+    args.reclaimed = True
+
+    mib = 1024 * 1024
+    logging.info("Reclaimed container memory in {:.1f}s: {} MiB -> {} MiB resident, {} MiB -> {} MiB swap".format(
+        time.monotonic() - start, before // mib, after // mib, swap_before // mib, swap_after // mib))
@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import urllib.parse
+from tools import helpers
+
+# Block-level delta updates.
+#
+# A channel build may carry a "chunks" key with the URL of a chunk manifest
+# for one of its images:
+#
+#     {
+#         "image": "system.img",
+#         "url": "<uncompressed image, served with Range support>",
+#         "size": <image size in bytes>,
+#         "sha256": "<hash of the whole image>",
+#         "chunk_size": <bytes per chunk>,
+#         "chunks": ["<sha256 of chunk 0>", "<sha256 of chunk 1>", ...]
+#     }
+#
+# The current image is hashed with the same chunking. Chunks found locally
+# are copied, only the others are fetched with Range requests, and the
+# rebuilt image has to match "sha256" before it is handed to the store.
+
+FETCH_CONNECTIONS = 4
+
+def fetch_manifest(url):
+    request = helpers.http.retrieve(url)
+    if request[0] != 200:
+        raise ValueError("Failed to get chunk manifest: {}, error: {}".format(url, request[0]))
+    manifest = json.loads(request[1].decode('utf8'))
+    manifest["url"] = urllib.parse.urljoin(url, manifest["url"])
+    if len(manifest["chunks"]) != -(-manifest["size"] // manifest["chunk_size"]):
+        raise ValueError("Chunk manifest {} doesn't cover the image".format(url))
+    return manifest
+
+def index_chunks(path, chunk_size):
+    """ :returns: dict of chunk sha256 to its offset in path """
+    index = {}
+    with open(path, "rb", buffering=0) as f:
+        offset = 0
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            index.setdefault(hashlib.sha256(chunk).hexdigest(), offset)
+            offset += len(chunk)
+    return index
+
+def missing_ranges(manifest, available):
+    """ Coalesce the chunks whose digest is not in available into
+        (first, last) chunk number ranges, so adjacent chunks share one
+        Range request. """
+    ranges = []
+    for i, digest in enumerate(manifest["chunks"]):
+        if digest in available:
+            continue
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+def chunk_manifest(manifest):
+    """ :returns: the Merkle manifest of the image a chunk manifest describes """
+    return {"size": manifest["size"], "chunk_size": manifest["chunk_size"],
+            "chunks": manifest["chunks"], "root": helpers.merkle.root(manifest["chunks"])}
+
+def apply(args, manifest, current_image, target, max_rate=0, cancel=None):
+    """ Rebuild the image described by manifest into target, reusing the
+        chunks of current_image.
+
+        :param max_rate: limit for the chunk fetches in bytes per second, 0
+                         for none
+        :param cancel: see tools.helpers.http.download()
+        :returns: number of bytes fetched from the network """
+    chunk_size = manifest["chunk_size"]
+    size = manifest["size"]
+    # All-zero chunks, full sized or the short last one, are left as holes
+    zeros = {hashlib.sha256(bytes(chunk_size)).hexdigest(),
+             hashlib.sha256(bytes(size % chunk_size or chunk_size)).hexdigest()}
+
+    logging.info("Indexing chunks of " + current_image)
+    index = index_chunks(current_image, chunk_size)
+    ranges = missing_ranges(manifest, index.keys() | zeros)
+    fetch_size = sum(min((last + 1) * chunk_size, size) - first * chunk_size
+                     for first, last in ranges)
+    logging.info("Delta update needs {} MB of {} MB".format(
+        fetch_size // 1000000, size // 1000000))
+
+    tmp_target = os.path.join(os.path.dirname(target), "." + os.path.basename(target) + ".tmp")
+    fd = os.open(tmp_target, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        # Copy what we already have, leaving zero chunks as holes
+        copied = []
+        with open(current_image, "rb", buffering=0) as src:
+            for i, digest in enumerate(manifest["chunks"]):
+                if digest not in index or digest in zeros:
+                    continue
+                length = min(chunk_size, size - i * chunk_size)
+                os.pwrite(fd, os.pread(src.fileno(), length, index[digest]), i * chunk_size)
+                copied.append(i)
+        # current_image may have changed since it was indexed, find out
+        # before fetching the rest
+        if helpers.merkle.verify(tmp_target, chunk_manifest(manifest), copied):
+            raise ValueError("{} changed while copying chunks from it".format(current_image))
+
+        throttle = helpers.http.Throttle(max_rate, cancel)
+
+        def fetch(first, last):
+            start = first * chunk_size
+            end = min((last + 1) * chunk_size, size)
+            with helpers.http.open_range(manifest["url"], start, end) as response:
+                for i in range(first, last + 1):
+                    length = min(chunk_size, size - i * chunk_size)
+                    chunk = response.read(length)
+                    throttle.consume(len(chunk))
+                    if hashlib.sha256(chunk).hexdigest() != manifest["chunks"][i]:
+                        raise ValueError("Chunk {} of {} doesn't match the manifest".format(
+                            i, manifest["url"]))
+                    os.pwrite(fd, chunk, i * chunk_size)
+
+        with concurrent.futures.ThreadPoolExecutor(FETCH_CONNECTIONS) as pool:
+            for future in [pool.submit(fetch, first, last) for first, last in ranges]:
+                future.result()
+
+        logging.info("Verifying rebuilt " + manifest["image"])
+        if helpers.images.sha256sum(tmp_target) != manifest["sha256"]:
+            raise ValueError("Rebuilt image hash doesn't match, expected: {}".format(
+                manifest["sha256"]))
+    except:
+        os.close(fd)
+        os.remove(tmp_target)
+        raise
+    os.close(fd)
+    os.replace(tmp_target, target)
+    return fetch_size
+
+def update(args, build, current_image, dest_dir, max_rate=0, cancel=None):
+    """ Try to rebuild the image of a channel build into dest_dir with a
+        delta update against current_image.
+
+        :param max_rate: download rate limit in bytes per second, 0 for none
+        :param cancel: see tools.helpers.http.download()
+        :returns: True on success, False if the full zip has to be downloaded """
+    if "chunks" not in build or not os.path.isfile(current_image):
+        return False
+    try:
+        manifest = fetch_manifest(build["chunks"])
+        apply(args, manifest, current_image, os.path.join(dest_dir, manifest["image"]),
+              max_rate, cancel)
+        # Every chunk was checked against the manifest, keep it for the store
+        helpers.merkle.save(os.path.join(dest_dir, helpers.store.MANIFEST),
+                            chunk_manifest(manifest))
+        return True
+    except helpers.http.Cancelled:
+        raise
+    except Exception as e:
+        logging.warning("Delta update failed ({}), downloading the full image".format(e))
+        return False
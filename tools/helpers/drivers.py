@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import logging
 import os
-import glob
+import ctypes
 import fcntl
 import struct
 import tools.config
@@ -27,6 +27,7 @@ HWBINDER_DRIVERS = [
     "hwbonder",
     "hwbinder"
 ]
+BINDERFS_PATH = "/dev/binderfs"
 
 
 def isBinderfsLoaded(args):
@@ -56,7 +57,7 @@ def allocBinderNodes(args, binder_dev_nodes):
         return IOC(READ|WRITE, _type, nr, size)
 
     BINDER_CTL_ADD = IOWR(98, 1, 264)
-    binderctrlfd = open('/dev/binderfs/binder-control','rb')
+    binderctrlfd = open(BINDERFS_PATH + '/binder-control','rb')
 
     for node in binder_dev_nodes:
         node_struct = struct.pack(
@@ -66,47 +67,62 @@ def allocBinderNodes(args, binder_dev_nodes):
         except FileExistsError:
             pass
 
+def mountBinderfs(args):
+    if os.path.ismount(BINDERFS_PATH):
+        return
+    os.makedirs(BINDERFS_PATH, exist_ok=True)
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                           ctypes.c_ulong, ctypes.c_void_p]
+    if libc.mount(b"binder", BINDERFS_PATH.encode(), b"binder", 0, None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Failed to mount binderfs: " + os.strerror(err))
+
+def linkBinderNodes(args):
+    for name in os.listdir(BINDERFS_PATH):
+        link = "/dev/" + name
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(BINDERFS_PATH, name), link)
+
+def missingBinderNodes(args):
+    """ :returns: the nodes to allocate, the first name of every kind of
+                  binder that has no node in /dev yet """
+    # Names picked by an earlier run are in waydroid.cfg, try those first
+    cfg = tools.config.load(args)
+    missing = []
+    for key, drivers in [("binder", BINDER_DRIVERS),
+                         ("vndbinder", VNDBINDER_DRIVERS),
+                         ("hwbinder", HWBINDER_DRIVERS)]:
+        cached = cfg["waydroid"].get(key)
+        if cached and os.path.exists("/dev/" + cached):
+            continue
+        if not any(os.path.exists("/dev/" + node) for node in drivers):
+            missing.append(drivers[0])
+    return missing
+
 def probeBinderDriver(args):
-    binder_dev_nodes = []
-    has_binder = False
-    has_vndbinder = False
-    has_hwbinder = False
-    for node in BINDER_DRIVERS:
-        if os.path.exists("/dev/" + node):
-            has_binder = True
-    if not has_binder:
-        binder_dev_nodes.append(BINDER_DRIVERS[0])
-    for node in VNDBINDER_DRIVERS:
-        if os.path.exists("/dev/" + node):
-            has_vndbinder = True
-    if not has_vndbinder:
-        binder_dev_nodes.append(VNDBINDER_DRIVERS[0])
-    for node in HWBINDER_DRIVERS:
-        if os.path.exists("/dev/" + node):
-            has_hwbinder = True
-    if not has_hwbinder:
-        binder_dev_nodes.append(HWBINDER_DRIVERS[0])
-
-    if len(binder_dev_nodes) > 0:
-        if not isBinderfsLoaded(args):
-            devices = ','.join(binder_dev_nodes)
-            command = ["modprobe", "binder_linux",
-                       "devices=\"{}\"".format(devices)]
-            output = tools.helpers.run.user(args, command, check=False, output_return=True)
-            if output:
-                logging.error("Failed to load binder driver")
-                logging.error(output.strip())
-
-        if isBinderfsLoaded(args):
-            command = ["mkdir", "-p", "/dev/binderfs"]
-            tools.helpers.run.user(args, command, check=False)
-            command = ["mount", "-t", "binder", "binder", "/dev/binderfs"]
-            tools.helpers.run.user(args, command, check=False)
+    binder_dev_nodes = missingBinderNodes(args)
+    if not binder_dev_nodes:
+        return 0
+
+    loaded = isBinderfsLoaded(args)
+    if not loaded:
+        devices = ','.join(binder_dev_nodes)
+        command = ["modprobe", "binder_linux",
+                   "devices=\"{}\"".format(devices)]
+        output = tools.helpers.run.user(args, command, check=False, output_return=True)
+        if output:
+            logging.error("Failed to load binder driver")
+            logging.error(output.strip())
+        loaded = isBinderfsLoaded(args)
+
+    if loaded:
+        try:
+            mountBinderfs(args)
             allocBinderNodes(args, binder_dev_nodes)
-            command = ["ln", "-s"]
-            command.extend(glob.glob("/dev/binderfs/*"))
-            command.append("/dev/")
-            tools.helpers.run.user(args, command, check=False)
+            linkBinderNodes(args)
+        except OSError as e:
+            logging.error(str(e))
 
     return 0
 
@@ -1,4 +1,5 @@
 import glob
+import logging
 import os
 import tools.config
 import tools.helpers.props
@@ -17,27 +18,122 @@ def getCardFromRender(args, dev):
     except IndexError:
         return ""
 
-def getDriNode(args):
-    cfg = tools.config.load(args)
-    
-    # Check if GPU is disabled
+def readSysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+# (names in /sys/class/drm, list of GPUs), rebuilt when a device comes or goes
+inventory_cache = (None, [])
+
+def inventory(args):
+    """ :returns: list of dicts describing every render node, sorted by node:
+                  render, card, driver, vendor, class, boot_vga, discrete """
+    global inventory_cache
+    try:
+        signature = tuple(sorted(os.listdir("/sys/class/drm")))
+    except OSError:
+        signature = ()
+    if inventory_cache[0] == signature:
+        return inventory_cache[1]
+
+    gpus = []
+    for name in signature:
+        if not name.startswith("renderD"):
+            continue
+        device = "/sys/class/drm/{}/device/".format(name)
+        gpus.append({
+            "render": "/dev/dri/" + name,
+            "card": getCardFromRender(args, name),
+            "driver": getKernelDriver(args, name),
+            "vendor": readSysfs(device + "vendor"),
+            "class": readSysfs(device + "class"),
+            "boot_vga": readSysfs(device + "boot_vga"),
+        })
+    gpus.sort(key=lambda gpu: int(gpu["render"][len("/dev/dri/renderD"):]))
+
+    # Platform devices (most ARM SoCs) are integrated. Of several PCI display
+    # controllers, the firmware boots from the integrated one on hybrid
+    # laptops, so the others are discrete cards.
+    pci = [gpu for gpu in gpus if gpu["class"].startswith("0x03")]
+    for gpu in gpus:
+        gpu["discrete"] = len(pci) > 1 and gpu in pci and gpu["boot_vga"] != "1"
+    inventory_cache = (signature, gpus)
+    return gpus
+
+def selectGpu(args, cfg):
+    """ Pick a render node according to gpu_policy:
+        auto        the first supported node
+        discrete    a discrete card if there is one
+        integrated  an integrated GPU if there is one
+        driver:X    a node driven by kernel driver X
+        drm_device in waydroid.cfg pins a node and overrides the policy. """
     if cfg["waydroid"].get("no_gpu") == "true":
-        return "", ""
-    
+        return None
+
+    gpus = inventory(args)
     node = cfg["waydroid"].get("drm_device")
     if node:
         if not os.path.exists(node):
             raise OSError("The specified drm_device {} does not exist".format(node))
+        for gpu in gpus:
+            if gpu["render"] == node:
+                return gpu if gpu["driver"] not in unsupported else None
         renderDev = os.path.basename(node)
         if getKernelDriver(args, renderDev) not in unsupported:
-            return node, getCardFromRender(args, renderDev)
+            return {"render": node, "card": getCardFromRender(args, renderDev),
+                    "driver": getKernelDriver(args, renderDev)}
+        return None
+
+    supported = [gpu for gpu in gpus if gpu["driver"] not in unsupported]
+    policy = cfg["waydroid"].get("gpu_policy", "auto")
+    preferred = []
+    if policy == "discrete":
+        preferred = [gpu for gpu in supported if gpu["discrete"]]
+    elif policy == "integrated":
+        preferred = [gpu for gpu in supported if not gpu["discrete"]]
+    elif policy.startswith("driver:"):
+        preferred = [gpu for gpu in supported if gpu["driver"] == policy[len("driver:"):]]
+    elif policy != "auto":
+        logging.warning("Unknown gpu_policy {}, using auto".format(policy))
+    for gpu in preferred + supported:
+        return gpu
+    return None
+
+# (inventory, waydroid.cfg mtime, selected GPU)
+selection_cache = (None, None, None)
+
+def getGpu(args):
+    global selection_cache
+    gpus = inventory(args)
+    try:
+        cfg_mtime = os.stat(args.config).st_mtime_ns
+    except OSError:
+        cfg_mtime = None
+    if selection_cache[0] is gpus and selection_cache[1] == cfg_mtime:
+        return selection_cache[2]
+    gpu = selectGpu(args, tools.config.load(args))
+    selection_cache = (gpus, cfg_mtime, gpu)
+    return gpu
+
+def getDriNode(args):
+    gpu = getGpu(args)
+    if gpu is None:
         return "", ""
+    return gpu["render"], gpu["card"]
 
-    for node in sorted(glob.glob("/dev/dri/renderD*")):
-        renderDev = os.path.basename(node)
-        if getKernelDriver(args, renderDev) not in unsupported:
-            return node, getCardFromRender(args, renderDev)
-    return "", ""
+def getIntelGen(args, card):
+    """ :returns: graphics version of an i915 card from debugfs, or 0 """
+    path = "/sys/kernel/debug/dri/{}/i915_capabilities".format(getMinor(args, card))
+    for line in readSysfs(path).splitlines():
+        if line.startswith("graphics version:") or line.startswith("gen:"):
+            try:
+                return int(line.split()[-1])
+            except ValueError:
+                pass
+    return 0
 
 def getVulkanDriver(args, dev):
     mapping = {
@@ -50,18 +146,17 @@ def getVulkanDriver(args, dev):
         "vc4": "broadcom",
         "nouveau": "nouveau",
     }
-    kernel_driver = getKernelDriver(args, dev)
+    gpu = next((gpu for gpu in inventory(args) if gpu["render"] == "/dev/dri/" + dev), None)
+    if gpu is not None and "vulkan" in gpu:
+        return gpu["vulkan"]
 
+    kernel_driver = getKernelDriver(args, dev)
+    vulkan = mapping.get(kernel_driver, "")
     if kernel_driver == "i915":
-        try:
-            dev = os.path.basename(getCardFromRender(args, dev))
-            gen = tools.helpers.run.user(args,["awk", "/^graphics version:|^gen:/ {print $NF}",
-                "/sys/kernel/debug/dri/{}/i915_capabilities".format(getMinor(args, dev))], output_return=True, check=False)
-            if int(gen) < 9:
-                return "intel_hasvk"
-        except:
-            pass
-
-    if kernel_driver in mapping:
-        return mapping[kernel_driver]
-    return ""
+        gen = getIntelGen(args, os.path.basename(getCardFromRender(args, dev)))
+        if 0 < gen < 9:
+            vulkan = "intel_hasvk"
+
+    if gpu is not None:
+        gpu["vulkan"] = vulkan
+    return vulkan
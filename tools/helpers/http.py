@@ -1,20 +1,314 @@
 # Copyright 2021 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import hashlib
+import http.client
+import json
 import logging
 import os
-import shutil
 import threading
+import urllib.error
+import urllib.parse
 import urllib.request
 
+import tools.config
+import tools.helpers.progress
 import tools.helpers.run
 import time
 
 
+# Segments are downloaded in blocks of this size, and the resume journal
+# is written at most once per JOURNAL_INTERVAL seconds
+BLOCK_SIZE = 1024 * 1024
+JOURNAL_INTERVAL = 1
+# Files smaller than this are not worth splitting across connections
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_RETRIES = 3
+
+# Keep-alive connections are reused per (scheme, host), up to
+# POOL_SIZE idle ones each
+POOL_SIZE = 8
+MAX_REDIRECTS = 5
+TIMEOUT = 60
+
+pool = {}
+pool_lock = threading.Lock()
+
+
+class PooledResponse:
+    """ A response on a pooled connection. The connection goes back to the
+        pool once the body has been read completely. """
+    def __init__(self, key, conn, response):
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def connect(key):
+    scheme, netloc = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+    return http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+
+
+def acquire(key):
+    """ :returns: (connection, whether it was reused from the pool) """
+    with pool_lock:
+        idle = pool.get(key)
+        if idle:
+            return idle.pop(), True
+    return connect(key), False
+
+
+def release(key, conn):
+    with pool_lock:
+        idle = pool.setdefault(key, [])
+        if len(idle) < POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def open_url(url, headers=None):
+    """ GET url over a pooled keep-alive connection, following redirects.
+
+        Behaves like urllib.request.urlopen(): error statuses raise
+        urllib.error.HTTPError. Other schemes, such as file://, and setups
+        with a proxy in the environment go through urllib itself.
+
+        :returns: response with status, headers, read() and close(), usable
+                  as a context manager """
+    headers = dict(headers or {})
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ["http", "https"] or parts.scheme in urllib.request.getproxies():
+            return urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        conn, reused = acquire(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+            # The server closed the idle connection, retry on a fresh one
+            conn = connect(key)
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+
+        pooled = PooledResponse(key, conn, response)
+        if response.status in [301, 302, 303, 307, 308] and response.headers.get("location"):
+            response.read()
+            pooled.close()
+            url = urllib.parse.urljoin(url, response.headers["location"])
+            continue
+        if response.status >= 300:
+            response.read()
+            pooled.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        return pooled
+    raise urllib.error.HTTPError(url, 310, "Too many redirects", {}, None)
+
+
+class Cancelled(Exception):
+    """ The download was given up on request, its journal is kept """
+
+
+class Throttle:
+    """ Caps the combined rate of the connections of a download. Every block
+        books the next free slot of time at rate bytes per second and waits
+        for it. A rate of 0 means no limit.
+
+        Every block also checks cancel, if given, and raises Cancelled once
+        it returns True. """
+    def __init__(self, rate=0, cancel=None):
+        self.rate = rate
+        self.cancel = cancel
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def consume(self, count):
+        if self.cancel and self.cancel():
+            raise Cancelled("Download cancelled")
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + count / self.rate
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ResourceChanged(OSError):
+    """ The file changed on the server since its download started """
+
+
+def load_journal(journal_path, url):
+    """ Load the resume journal of a partial download.
+
+        :returns: the journal dict, or None if there is no usable journal """
+    try:
+        with open(journal_path) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if journal.get("url") != url:
+        return None
+    return journal
+
+
+def save_journal(journal_path, journal):
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(journal, f)
+    os.replace(tmp_path, journal_path)
+
+
+def range_validator(headers):
+    """ :returns: the ETag, or the Last-Modified date if the ETag is missing
+                  or weak, to send as If-Range. None if there is neither. """
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+
+def probe(url):
+    """ Open url asking for its first byte, to find out whether the server
+        supports Range requests.
+
+        :returns: (response, total) where total is the full size in bytes if
+                  the server answered with 206 Partial Content, or None if it
+                  ignored the Range header and is sending the whole body """
+    response = open_url(url, headers={"Range": "bytes=0-0"})
+    if response.status == 206:
+        content_range = response.headers.get("content-range", "")
+        try:
+            return response, int(content_range.rpartition("/")[2])
+        except ValueError:
+            pass
+    return response, None
+
+
+def open_range(url, start, end, validator=None):
+    """ Open a Range request for the bytes [start, end) of url.
+
+        :param validator: ETag or Last-Modified date of the version being
+                          downloaded, sent as If-Range
+        :returns: the response, positioned at start
+        :raises ResourceChanged: if the server sent the whole file because
+                                 it no longer matches validator
+        :raises OSError: if the server doesn't answer with 206 """
+    headers = {"Range": "bytes={}-{}".format(start, end - 1)}
+    if validator:
+        headers["If-Range"] = validator
+    response = open_url(url, headers=headers)
+    if response.status != 206:
+        response.close()
+        if validator and response.status == 200:
+            raise ResourceChanged("File changed on the server: " + url)
+        raise OSError("Server doesn't honor Range requests: " + url)
+    return response
+
+
+def split_segments(total, connections):
+    count = max(1, min(connections, total // MIN_SEGMENT_SIZE))
+    size = max(1, -(-total // count))
+    # [start, end, position] with end exclusive
+    return [[start, min(start + size, total), start]
+            for start in range(0, total, size)]
+
+
+def download_segments(url, path, journal, journal_path, reporter, throttle):
+    """ Fill the preallocated file at path with Range requests, one thread
+        per unfinished segment of the journal. """
+    lock = threading.Lock()
+    errors = []
+    last_save = [time.monotonic()]
+
+    def checkpoint(force=False):
+        with lock:
+            now = time.monotonic()
+            if force or now - last_save[0] >= JOURNAL_INTERVAL:
+                save_journal(journal_path, journal)
+                last_save[0] = now
+
+    def worker(fd, segment):
+        attempt = 0
+        while segment[2] < segment[1] and not errors:
+            try:
+                with open_range(url, segment[2], segment[1], journal.get("validator")) as response:
+                    while segment[2] < segment[1] and not errors:
+                        block = response.read(min(BLOCK_SIZE, segment[1] - segment[2]))
+                        if not block:
+                            raise OSError("Connection closed at {} of {}".format(
+                                segment[2], segment[1]))
+                        throttle.consume(len(block))
+                        os.pwrite(fd, block, segment[2])
+                        segment[2] += len(block)
+                        reporter.advance(len(block))
+                        checkpoint()
+            except (ResourceChanged, Cancelled) as e:
+                errors.append(e)
+                return
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == SEGMENT_RETRIES or errors:
+                    errors.append(e)
+                    return
+                logging.debug("Segment at {} failed ({}), retrying".format(segment[2], e))
+                time.sleep(2 ** attempt)
+                attempt += 1
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        threads = []
+        for segment in journal["segments"]:
+            if segment[2] < segment[1]:
+                thread = threading.Thread(target=worker, args=(fd, segment), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        os.close(fd)
+        checkpoint(force=True)
+    if errors:
+        raise errors[0]
+
+
 def download(args, url, prefix, cache=True, loglevel=logging.INFO,
-             allow_404=False):
+             allow_404=False, connections=4, sha256=None, max_rate=0, cancel=None):
     """ Download a file to disk.
 
+        Servers that support Range requests are downloaded over several
+        connections into a preallocated file. Progress is kept in a journal
+        next to the file in the cache, so an interrupted download continues
+        where it stopped on the next call, even with cache=False.
+
         :param url: the http(s) address of to the file to download
         :param prefix: for the cache, to make it easier to find (cache files
                        get a hash of the URL after the prefix)
@@ -26,71 +320,16 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
         :param allow_404: do not raise an exception when the server responds
                           with a 404 Not Found error. Only display a warning on
                           stdout (no matter if loglevel is changed).
+        :param connections: maximum number of parallel Range requests
+        :param sha256: expected hex digest of the file. It is computed while
+                       the file is written, and a mismatch removes the file
+                       and raises ValueError.
+        :param max_rate: limit for all connections together in bytes per
+                         second, 0 for none
+        :param cancel: called while downloading, the download stops with
+                       Cancelled once it returns True. The journal is kept
+                       for the next call to resume from.
         :returns: path to the downloaded file in the cache or None on 404 """
-    
-    # helper functions for progress
-    def fromBytesToMB(numBytes, decimalPlaces=2):
-        return round(int(numBytes)/1000000, decimalPlaces)
-    
-    def getDownloadSpeed(lastSize, currentSize, timeTaken, decimalPlaces=2):
-        # sizes are in mb and timeTaken in seconds
-        speedUnit = "mbps"
-        sizeDifference = currentSize-lastSize
-
-        if sizeDifference < 1:
-            # sizeDifference is less than 1 mb
-            # convert sizeDifference to kb and speedUnit to kbps,
-            # for better readability
-            sizeDifference*=1000
-            speedUnit = "kbps"
-        
-        # sizeDifference mb(or kb) was downloaded in timeTaken seconds
-        # so downloadSpeed = sizeDifference/timeTaken mbps(or kbps)
-        return (round(sizeDifference/timeTaken, decimalPlaces), speedUnit)
-
-    # Show progress while downloading
-    downloadEnded = False
-    def progress(totalSize, destinationPath):
-        # convert totalSize to mb before hand,
-        # it's value won't change inside while loop and
-        # will be unnecessarily calculated every .01 seconds 
-        totalSize = fromBytesToMB(totalSize)
-
-        # this value will be used to figure out maximum chars
-        # required to denote downloaded size later on
-        totalSizeStrLen = len(str(totalSize))
-
-        # lastSize and lastSizeChangeAt is used to calculate speed
-        lastSize = 0
-        lastSizeChangeAt = time.time()
-
-        downloadSpeed = 0, "mbps"
-
-        while not downloadEnded:
-            currentSize = fromBytesToMB(os.path.getsize(destinationPath))
-            
-            if currentSize != lastSize:
-                sizeChangeAt = time.time()
-                downloadSpeed = getDownloadSpeed(
-                    lastSize, currentSize,
-                    timeTaken=sizeChangeAt-lastSizeChangeAt
-                )
-
-                lastSize = currentSize
-                lastSizeChangeAt = sizeChangeAt
-
-                # make currentSize and downloadSpeed of a fix max len,
-                # to avoid previously printed chars to appear while \
-                # printing recursively
-                # currentSize is not going to exceed totalSize
-                currentSize = str(currentSize).rjust(totalSizeStrLen)
-                # assuming max downloadSpeed to be 9999.99 mbps
-                downloadSpeed = f"{str(downloadSpeed[0]).rjust(7)} {downloadSpeed[1]}"
-                
-                # print progress bar
-                print(f"\r[Downloading] {currentSize} MB/{totalSize} MB    {downloadSpeed}(approx.)", end=" ")
-            time.sleep(.01)
-
     # Create cache folder
     if not os.path.exists(args.work + "/cache_http"):
         tools.helpers.run.user(args, ["mkdir", "-p", args.work + "/cache_http"])
@@ -99,29 +338,121 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
     prefix = prefix.replace("/", "_")
     path = (args.work + "/cache_http/" + prefix + "_" +
             hashlib.sha256(url.encode("utf-8")).hexdigest())
-    if os.path.exists(path):
-        if cache:
+    journal_path = path + ".journal"
+    journal = load_journal(journal_path, url)
+    if os.path.exists(path) and journal is None:
+        if cache and not os.path.exists(journal_path):
+            if sha256:
+                return verify(path, journal_path, tools.helpers.images.sha256sum(path), sha256)
             return path
-        tools.helpers.run.user(args, ["rm", path])
+        tools.helpers.run.user(args, ["rm", "-f", path, journal_path])
 
     # Download the file
     logging.log(loglevel, "Downloading " + url)
     try:
-        with urllib.request.urlopen(url) as response:
-            with open(path, "wb") as handle:
-                # adding daemon=True will kill this thread if main thread is killed
-                # else progress_bar will continue to show even if user cancels download by ctrl+c
-                threading.Thread(target=progress, args=(response.headers.get('content-length'), path), daemon=True).start()
-                shutil.copyfileobj(response, handle)
+        response, total = probe(url)
     # Handle 404
     except urllib.error.HTTPError as e:
         if e.code == 404 and allow_404:
             logging.warning("WARNING: file not found: " + url)
             return None
         raise
-    downloadEnded = True
+
+    validator = range_validator(response.headers)
+    progress = {"ended": False}
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    hasher = hashlib.sha256()
+    throttle = Throttle(max_rate, cancel)
+    with response:
+        if total is None:
+            # No Range support, fall back to a single stream from scratch
+            if journal is not None:
+                os.remove(journal_path)
+            reporter = tools.helpers.progress.Reporter(
+                "download", response.headers.get("content-length"), name)
+            with open(path, "wb") as handle:
+                for block in iter(lambda: response.read(BLOCK_SIZE), b""):
+                    throttle.consume(len(block))
+                    handle.write(block)
+                    hasher.update(block)
+                    reporter.advance(len(block))
+            reporter.finish()
+            return verify(path, journal_path, hasher.hexdigest(), sha256)
+
+    if journal is None or journal["total"] != total or \
+            journal.get("validator") != validator or not os.path.exists(path):
+        journal = {"url": url, "total": total, "validator": validator,
+                   "segments": split_segments(total, connections)}
+        with open(path, "wb") as handle:
+            try:
+                os.posix_fallocate(handle.fileno(), 0, total)
+            except OSError:
+                handle.truncate(total)
+        save_journal(journal_path, journal)
+    else:
+        logging.info("Resuming download of " + url)
+
+    reporter = tools.helpers.progress.Reporter("download", total, name)
+    reporter.update(sum(s[2] - s[0] for s in journal["segments"]))
+    hash_thread = None
+    if sha256:
+        hash_thread = threading.Thread(target=hash_segments,
+                                       args=(path, journal, hasher, progress), daemon=True)
+        hash_thread.start()
+    try:
+        download_segments(url, path, journal, journal_path, reporter, throttle)
+    except ResourceChanged:
+        logging.info("{} changed on the server, starting over".format(url))
+        progress["ended"] = True
+        if hash_thread:
+            hash_thread.join()
+        os.remove(journal_path)
+        os.remove(path)
+        return download(args, url, prefix, cache, loglevel, allow_404,
+                        connections, sha256, max_rate, cancel)
+    finally:
+        progress["ended"] = True
+    reporter.finish()
+    if hash_thread:
+        hash_thread.join()
+    os.remove(journal_path)
 
     # Return path in cache
+    return verify(path, journal_path, hasher.hexdigest() if sha256 else None, sha256)
+
+
+def hash_segments(path, journal, hasher, progress):
+    """ Feed hasher with the contiguous downloaded prefix of path while the
+        segments are still being written, so the blocks are read back from
+        the page cache instead of from disk after the download. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pos = 0
+        for segment in journal["segments"]:
+            while pos < segment[1]:
+                available = segment[2] - pos
+                if available <= 0:
+                    if progress["ended"] and segment[2] < segment[1]:
+                        return
+                    time.sleep(.01)
+                    continue
+                block = os.pread(fd, min(available, BLOCK_SIZE), pos)
+                hasher.update(block)
+                pos += len(block)
+    finally:
+        os.close(fd)
+
+
+def verify(path, journal_path, digest, sha256):
+    """ Compare the digest computed while downloading with the expected one
+        and drop the download if they differ.
+
+        :returns: path """
+    if sha256 and digest != sha256:
+        for p in [path, journal_path]:
+            if os.path.exists(p):
+                os.remove(p)
+        raise ValueError("Downloaded file hash doesn't match, expected: {}".format(sha256))
     return path
 
 
@@ -139,8 +470,7 @@ def retrieve(url, headers=None):
         headers = {}
 
     try:
-        req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req) as response:
+        with open_url(url, headers) as response:
             return 200, response.read()
     # Handle malformed URL
     except ValueError as e:
@@ -148,3 +478,82 @@ def retrieve(url, headers=None):
     # Handle 404
     except urllib.error.HTTPError as e:
         return e.code, ""
+
+
+# Parsed channel documents shared by every caller in this process, as
+# url: (time fetched, status, document)
+channel_cache = {}
+
+
+def channel_cache_path(args, url):
+    return (args.work + "/cache_http/channel_" +
+            hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+
+def save_channel_cache(path, cached):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cached, f)
+    os.replace(path + ".tmp", path)
+
+
+def retrieve_json(args, url):
+    """ Fetch a JSON document such as an OTA channel, revalidating a cached
+        copy instead of downloading it again.
+
+        The body is kept under cache_http with its ETag and Last-Modified.
+        Within channel_ttl seconds of the last fetch it is used as is, after
+        that it is refreshed with a conditional request that the server can
+        answer with 304 Not Modified. When the server can't be reached at
+        all, the cached copy is used regardless of its age.
+
+        :returns: status and the parsed document (None unless status is 200)
+    """
+    ttl = int(tools.config.load(args)["waydroid"]["channel_ttl"])
+    now = time.time()
+    if url in channel_cache and now - channel_cache[url][0] < ttl:
+        return channel_cache[url][1:]
+
+    path = channel_cache_path(args, url)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        document = json.loads(cached["body"])
+    except (OSError, ValueError, KeyError):
+        cached = None
+
+    if cached is None or now - cached["fetched"] >= ttl:
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        logging.verbose("Retrieving " + url)
+        try:
+            with open_url(url, headers) as response:
+                body = response.read().decode("utf-8")
+                # Never cache what can't be parsed
+                document = json.loads(body)
+                cached = {"etag": response.headers.get("etag"),
+                          "last_modified": response.headers.get("last-modified"),
+                          "body": body}
+        # Handle malformed URL or document
+        except ValueError as e:
+            logging.verbose("Failed to retrieve {}: {}".format(url, e))
+            return -1, None
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or cached is None:
+                return e.code, None
+            logging.verbose("Not modified: " + url)
+        except (OSError, http.client.HTTPException) as e:
+            if cached is None:
+                logging.verbose("Failed to retrieve {}: {}".format(url, e))
+                return -1, None
+            logging.warning("Can't reach {} ({}), using the cached copy".format(url, e))
+            # Keep the old fetch time, so the next call tries again
+            now = cached["fetched"]
+        cached["fetched"] = now
+        save_channel_cache(path, cached)
+
+    channel_cache[url] = (cached["fetched"], 200, document)
+    return channel_cache[url][1:]
@@ -1,125 +1,310 @@
 # Copyright 2021 Erfan Abdi
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
+import contextlib
+import errno
 import logging
 import zipfile
-import json
 import hashlib
 import shutil
+import struct
+import fcntl
+import json
 import os
+import threading
+import urllib.parse
 import tools.config
 from tools import helpers
 from shutil import which
 
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+# linux/fsverity.h
+FS_IOC_ENABLE_VERITY = 0x40806685
+FS_IOC_MEASURE_VERITY = 0xc0046686
+FS_VERITY_HASH_ALG_SHA256 = 1
+FS_VERITY_BLOCK_SIZE = 4096
+
+def file_key(filename):
+    """ :returns: what changes whenever filename is written to or replaced,
+                  utime() can't set the ctime back """
+    st = os.stat(filename)
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
 def sha256sum(filename):
     h = hashlib.sha256()
     b = bytearray(128*1024)
     mv = memoryview(b)
+    reporter = helpers.progress.Reporter("verify", os.path.getsize(filename),
+                                         os.path.basename(filename))
     with open(filename, 'rb', buffering=0) as f:
         for n in iter(lambda: f.readinto(mv), 0):
             h.update(mv[:n])
+            reporter.advance(n)
+    reporter.finish()
     return h.hexdigest()
 
+def verity_measure(filename):
+    """ :returns: fs-verity digest of filename as hex, or None if it isn't
+                  sealed or the filesystem doesn't support fs-verity """
+    buf = bytearray(struct.pack("HH", 0, 64) + bytes(64))
+    try:
+        with open(filename, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_MEASURE_VERITY, buf)
+    except OSError:
+        return None
+    _, size = struct.unpack_from("HH", buf)
+    return buf[4:4 + size].hex()
 
-def get(args):
-    cfg = tools.config.load(args)
-    system_ota = cfg["waydroid"]["system_ota"]
-    system_request = helpers.http.retrieve(system_ota)
-    if system_request[0] != 200:
+def verity_seal(filename):
+    """ Enable fs-verity on filename. The kernel builds the Merkle tree once,
+        the file becomes read-only and its digest can be read back in
+        constant time with verity_measure().
+
+        :returns: fs-verity digest, or None if not supported here """
+    arg = struct.pack("IIIIQIIQ88x", 1, FS_VERITY_HASH_ALG_SHA256,
+                      FS_VERITY_BLOCK_SIZE, 0, 0, 0, 0, 0)
+    try:
+        with open(filename, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_ENABLE_VERITY, arg)
+    except OSError as e:
+        # EEXIST: already sealed
+        if e.errno != errno.EEXIST:
+            logging.debug("Not sealing {} with fs-verity: {}".format(filename, e))
+            return None
+    return verity_measure(filename)
+
+
+def extract_member(zip_ref, info, target):
+    """ Extract one member of an open ZipFile to target, keeping it sparse.
+
+        All-zero blocks are skipped with lseek instead of written, so the
+        large empty regions of ext4 images don't take disk space. The member
+        is written to a temporary name and renamed once zipfile has checked
+        its CRC, so a failed extraction never leaves a truncated image.
+
+        :returns: chunk manifest of the extracted file, see
+                  tools.helpers.merkle, hashed as it was written """
+    zero = bytes(SPARSE_BLOCK_SIZE)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_target = os.path.join(os.path.dirname(target), "." + os.path.basename(target) + ".tmp")
+    reporter = helpers.progress.Reporter("extract", info.file_size, os.path.basename(info.filename))
+    hasher = helpers.merkle.Hasher()
+    fd = os.open(tmp_target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with zip_ref.open(info) as member:
+            for block in iter(lambda: member.read(SPARSE_BLOCK_SIZE), b""):
+                hasher.update(block)
+                if block == zero[:len(block)]:
+                    os.lseek(fd, len(block), os.SEEK_CUR)
+                else:
+                    os.write(fd, block)
+                reporter.advance(len(block))
+        os.ftruncate(fd, info.file_size)
+        reporter.finish()
+    except:
+        os.close(fd)
+        os.remove(tmp_target)
+        raise
+    os.close(fd)
+    os.replace(tmp_target, target)
+    return hasher.manifest()
+
+def extract(images_zip, dest_dir):
+    """ Extract every member of images_zip into dest_dir, keeping the
+        images sparse.
+
+        :returns: dict of member name to its chunk manifest """
+    root = os.path.realpath(dest_dir)
+    manifests = {}
+    with zipfile.ZipFile(images_zip, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            # Never write outside dest_dir, like ZipFile.extractall
+            target = os.path.realpath(os.path.join(root, info.filename))
+            if os.path.isabs(info.filename) or os.path.commonpath([root, target]) != root:
+                raise ValueError("Refusing to extract {} outside of {}".format(
+                    info.filename, dest_dir))
+            manifests[info.filename] = extract_member(zip_ref, info, target)
+    return manifests
+
+def fetch(args, kind, build, max_rate=0, wait=True, network=None):
+    """ Make a channel build available in the image store, through a delta
+        update against the active image or the full zip.
+
+        :param max_rate: download rate limit in bytes per second, 0 for none
+        :param wait: wait for another process importing the same build,
+                     asking it to give way if it is the background stager.
+                     Otherwise return False right away, and give way to a
+                     waiting process in the middle of the transfer, which
+                     resumes from where this one stopped.
+        :param network: lock held while the build is downloaded, so
+                        concurrent fetches download one after another and
+                        one can extract while the next downloads
+        :returns: True if the build is in the store """
+    with helpers.store.locked(args, kind, build['id'], wait) as acquired:
+        if not acquired:
+            return False
+        if helpers.store.has(args, kind, build['id']):
+            return True
+        staging = helpers.store.staging_dir(args, kind, build['id'])
+        current_image = os.path.join(args.images_path, kind + ".img")
+        cancel = None
+        if not wait:
+            cancel = lambda: helpers.store.yield_requested(args, kind, build['id'])
+        try:
+            with network or contextlib.nullcontext():
+                if helpers.delta.update(args, build, current_image, staging, max_rate, cancel):
+                    images_zip = None
+                else:
+                    images_zip = helpers.http.download(
+                        args, build['url'], build['filename'], cache=False,
+                        sha256=build['id'], max_rate=max_rate, cancel=cancel)
+        except helpers.http.Cancelled:
+            logging.info("Leaving {} image {} to the process waiting for it".format(
+                kind, build['id']))
+            return False
+        if images_zip:
+            logging.info("Extracting " + build['filename'])
+            manifest = extract(images_zip, staging).get(kind + ".img")
+            helpers.store.keep_zip(args, staging, images_zip)
+        else:
+            manifest = None
+        helpers.store.commit(args, kind, build, staging, manifest)
+    return True
+
+def channel_update(args, cfg, kind):
+    """ :returns: the newest build on the channel of kind that is newer than
+                  the installed one, or None """
+    ota = cfg["waydroid"][kind + "_ota"]
+    request = helpers.bundle.retrieve_channel(args, ota)
+    if request[0] != 200:
         raise ValueError(
-            "Failed to get system OTA channel: {}, error: {}".format(args.system_ota, system_request[0]))
-    system_responses = json.loads(system_request[1].decode('utf8'))["response"]
-    if len(system_responses) < 1:
-        raise ValueError("No images found on system channel")
+            "Failed to get {} OTA channel: {}, error: {}".format(kind, ota, request[0]))
+    responses = request[1]["response"]
+    if len(responses) < 1:
+        raise ValueError("No images found on {} channel".format(kind))
 
     # Filter by LineageOS version if specified
-    if hasattr(args, 'desired_lineage_version'):
-        filtered_responses = [r for r in system_responses if r.get('version') == args.desired_lineage_version]
+    if kind == "system" and hasattr(args, 'desired_lineage_version'):
+        filtered_responses = [r for r in responses if r.get('version') == args.desired_lineage_version]
         if filtered_responses:
-            system_responses = filtered_responses
+            responses = filtered_responses
             logging.info(f"Found {len(filtered_responses)} image(s) for LineageOS {args.desired_lineage_version}")
         else:
             logging.warning(f"No images found for LineageOS {args.desired_lineage_version}, using latest available")
 
-    for system_response in system_responses:
-        if system_response['datetime'] > int(cfg["waydroid"]["system_datetime"]):
-            images_zip = helpers.http.download(
-                args, system_response['url'], system_response['filename'], cache=False)
-            logging.info("Validating system image")
-            if sha256sum(images_zip) != system_response['id']:
-                try:
-                    os.remove(images_zip)
-                except:
-                    pass
-                raise ValueError("Downloaded system image hash doesn't match, expected: {}".format(
-                    system_response['id']))
-            logging.info("Extracting to " + args.images_path)
-            with zipfile.ZipFile(images_zip, 'r') as zip_ref:
-                zip_ref.extractall(args.images_path)
-            cfg["waydroid"]["system_datetime"] = str(system_response['datetime'])
-            tools.config.save(args, cfg)
-            os.remove(images_zip)
-            break
+    for response in responses:
+        if response['datetime'] > int(cfg["waydroid"][kind + "_datetime"]):
+            # Channels on a mirror may point at their files relatively
+            build = dict(response)
+            for key in ["url", "chunks"]:
+                if key in build:
+                    build[key] = urllib.parse.urljoin(ota, build[key])
+            return build
+    return None
 
-    vendor_ota = cfg["waydroid"]["vendor_ota"]
-    vendor_request = helpers.http.retrieve(vendor_ota)
-    if vendor_request[0] != 200:
-        raise ValueError(
-            "Failed to get vendor OTA channel: {}, error: {}".format(vendor_ota, vendor_request[0]))
-    vendor_responses = json.loads(vendor_request[1].decode('utf8'))["response"]
-    if len(vendor_responses) < 1:
-        raise ValueError("No images found on vendor channel")
-
-    for vendor_response in vendor_responses:
-        if vendor_response['datetime'] > int(cfg["waydroid"]["vendor_datetime"]):
-            images_zip = helpers.http.download(
-                args, vendor_response['url'], vendor_response['filename'], cache=False)
-            logging.info("Validating vendor image")
-            if sha256sum(images_zip) != vendor_response['id']:
-                try:
-                    os.remove(images_zip)
-                except:
-                    pass
-                raise ValueError("Downloaded vendor image hash doesn't match, expected: {}".format(
-                    vendor_response['id']))
-            logging.info("Extracting to " + args.images_path)
-            with zipfile.ZipFile(images_zip, 'r') as zip_ref:
-                zip_ref.extractall(args.images_path)
-            cfg["waydroid"]["vendor_datetime"] = str(vendor_response['datetime'])
-            tools.config.save(args, cfg)
-            os.remove(images_zip)
-            break
-    remove_overlay(args)
+def get(args):
+    cfg = tools.config.load(args)
+    for kind in helpers.store.KINDS:
+        helpers.store.adopt(args, kind, args.images_path, cfg["waydroid"][kind + "_datetime"])
+
+    # Fetch both channels at once, then download one build after the other
+    # while the previous one is being verified and extracted
+    with concurrent.futures.ThreadPoolExecutor(len(helpers.store.KINDS)) as pool:
+        updates = [(kind, pool.submit(channel_update, args, cfg, kind))
+                   for kind in helpers.store.KINDS]
+        updates = [(kind, update.result()) for kind, update in updates]
+        updates = [(kind, build) for kind, build in updates if build is not None]
+        network = threading.Lock()
+        fetches = [pool.submit(fetch, args, kind, build, network=network)
+                   for kind, build in updates]
+        for future in fetches:
+            future.result()
+
+    # Only switch once every image is in the store
+    changed = False
+    for kind, build in updates:
+        if helpers.store.activate(args, kind, build['id'], args.images_path):
+            changed = True
+        cfg["waydroid"][kind + "_datetime"] = str(build['datetime'])
+    if updates:
+        tools.config.save(args, cfg)
+    helpers.store.evict(args, args.images_path)
+    if changed:
+        remove_overlay(args)
 
 def validate(args, channel, image_zip):
-    # Verify that the zip comes from the channel
+    """ Verify that the zip comes from the channel.
+
+        :returns: {"sha256": digest, "key": file_key()} of the zip, to hand
+                  to stage(), or None if it isn't a build of the channel """
     cfg = tools.config.load(args)
     channel_url = cfg["waydroid"][channel]
-    channel_request = helpers.http.retrieve(channel_url)
+    channel_request = helpers.http.retrieve_json(args, channel_url)
     if channel_request[0] != 200:
-        return False
-    channel_responses = json.loads(channel_request[1].decode('utf8'))["response"]
+        return None
+    channel_responses = channel_request[1]["response"]
+    # Taken before hashing, so a write during it shows too
+    key = file_key(image_zip)
+    digest = sha256sum(image_zip)
     for build in channel_responses:
-        if sha256sum(image_zip) == build['id']:
-            return True
+        if digest == build['id']:
+            return {"sha256": digest, "key": key}
     logging.warning(f"Could not verify the image {image_zip} against {channel_url}")
-    return False
+    return None
 
-def replace(args, system_zip, system_time, vendor_zip, vendor_time):
+def stage(args, system_zip, system_time, vendor_zip, vendor_time, validated=None):
+    """ Import upgrade zips into the image store next to the active
+        versions, which stay untouched, so this can run while the container
+        is up.
+
+        :param validated: dict of zip path to what validate() returned for
+                          it, so zips left untouched since aren't hashed
+                          again
+        :returns: list of (kind, build) to hand to switch() """
     cfg = tools.config.load(args)
     args.images_path = cfg["waydroid"]["images_path"]
-    if os.path.exists(system_zip):
-        with zipfile.ZipFile(system_zip, 'r') as zip_ref:
-            zip_ref.extractall(args.images_path)
-        os.remove(system_zip)
-        cfg["waydroid"]["system_datetime"] = str(system_time)
-        tools.config.save(args, cfg)
-    if os.path.exists(vendor_zip):
-        with zipfile.ZipFile(vendor_zip, 'r') as zip_ref:
-            zip_ref.extractall(args.images_path)
-        os.remove(vendor_zip)
-        cfg["waydroid"]["vendor_datetime"] = str(vendor_time)
-        tools.config.save(args, cfg)
-    remove_overlay(args)
+    staged = []
+    for kind, images_zip, datetime in [("system", system_zip, system_time),
+                                       ("vendor", vendor_zip, vendor_time)]:
+        if not os.path.exists(images_zip):
+            continue
+        helpers.store.adopt(args, kind, args.images_path, cfg["waydroid"][kind + "_datetime"])
+        digest = (validated or {}).get(images_zip)
+        if digest is None or digest["key"] != file_key(images_zip):
+            digest = {"sha256": sha256sum(images_zip)}
+        build = {"id": digest["sha256"], "datetime": datetime,
+                 "filename": os.path.basename(images_zip)}
+        with helpers.store.locked(args, kind, build["id"]):
+            if not helpers.store.has(args, kind, build["id"]):
+                staging = helpers.store.staging_dir(args, kind, build["id"])
+                logging.info("Extracting " + build["filename"])
+                manifest = extract(images_zip, staging).get(kind + ".img")
+                helpers.store.keep_zip(args, staging, images_zip)
+                helpers.store.commit(args, kind, build, staging, manifest)
+            else:
+                os.remove(images_zip)
+        staged.append((kind, build))
+    return staged
+
+def switch(args, staged):
+    """ Point images_path at versions imported by stage(). The container
+        has to be stopped and its rootfs unmounted. """
+    cfg = tools.config.load(args)
+    changed = False
+    for kind, build in staged:
+        if helpers.store.activate(args, kind, build["id"], args.images_path):
+            changed = True
+        cfg["waydroid"][kind + "_datetime"] = str(build["datetime"])
+    tools.config.save(args, cfg)
+    helpers.store.evict(args, args.images_path)
+    if changed:
+        remove_overlay(args)
+
+def replace(args, system_zip, system_time, vendor_zip, vendor_time):
+    switch(args, stage(args, system_zip, system_time, vendor_zip, vendor_time))
 
 def remove_overlay(args):
     if os.path.isdir(tools.config.defaults["overlay_rw"]):
@@ -130,36 +315,38 @@ def remove_overlay(args):
 def make_prop(args, cfg, full_props_path):
     if not os.path.isfile(args.work + "/waydroid_base.prop"):
         raise RuntimeError("waydroid_base.prop Not found")
-    with open(args.work + "/waydroid_base.prop") as f:
-        props = f.read().splitlines()
-    if not props:
+    base = helpers.props.file_props(args, args.work + "/waydroid_base.prop")
+    if not base:
         raise RuntimeError("waydroid_base.prop is broken!!?")
 
+    session = {}
     def add_prop(key, cfg_key):
         value = cfg[cfg_key]
         if value != "None":
             value = value.replace("/mnt/", "/mnt_extra/")
-            props.append(key + "=" + value)
+            session[key] = value
 
     add_prop("waydroid.host.user", "user_name")
     add_prop("waydroid.host.uid", "user_id")
     add_prop("waydroid.host.gid", "group_id")
     add_prop("waydroid.host_data_path", "waydroid_data")
     add_prop("waydroid.background_start", "background_start")
-    props.append("waydroid.xdg_runtime_dir=" + tools.config.defaults["container_xdg_runtime_dir"])
-    props.append("waydroid.pulse_runtime_path=" + tools.config.defaults["container_pulse_runtime_path"])
-    props.append("waydroid.wayland_display=" + tools.config.defaults["container_wayland_display"])
+    session["waydroid.xdg_runtime_dir"] = tools.config.defaults["container_xdg_runtime_dir"]
+    session["waydroid.pulse_runtime_path"] = tools.config.defaults["container_pulse_runtime_path"]
+    session["waydroid.wayland_display"] = tools.config.defaults["container_wayland_display"]
     if which("waydroid-sensord") is None:
-        props.append("waydroid.stub_sensors_hal=1")
+        session["waydroid.stub_sensors_hal"] = "1"
     dpi = cfg["lcd_density"]
     if dpi != "0":
-        props.append("ro.sf.lcd_density=" + dpi)
+        session["ro.sf.lcd_density"] = dpi
 
-    final_props = open(full_props_path, "w")
-    for prop in props:
-        final_props.write(prop + "\n")
-    final_props.close()
-    os.chmod(full_props_path, 0o644)
+    # The session values used to be appended to the base ones, so base
+    # ro.* values, [properties] from waydroid.cfg included, come first
+    layers = helpers.props.Layers()
+    layers.add("base", base)
+    layers.add("session", session, keep_ro=True)
+    layers.write(full_props_path)
+    return layers
 
 def mount_rootfs(args, images_dir, session):
     cfg = tools.config.load(args)
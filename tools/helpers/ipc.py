@@ -1,44 +1,289 @@
 # Copyright 2022 Alessandro Astone
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-# Currently implemented as FIFO
+# Channels are SOCK_SEQPACKET unix sockets. The process that creates a
+# channel publishes on it, any number of subscribers connect to it and get
+# every message whole and in order. Sends block while a subscriber's socket
+# buffer is full, so a slow reader slows the publisher down instead of
+# losing messages; one that stops reading for SEND_TIMEOUT is dropped.
+import contextlib
 import os
+import select
+import socket
+import struct
+import threading
+import time
 import dbus
+from gi.repository import GLib
 
 BASE_DIR = "/var/run/"
 
-def pipe_for(channel):
-    return BASE_DIR + "waydroid-" + channel
+# Messages are a 4 byte length and the payload, split over as many packets
+# as needed
+MAX_PACKET = 64 * 1024
+HEADER = struct.Struct("!I")
+SEND_TIMEOUT = 5
+# struct ucred of SO_PEERCRED: pid, uid, gid
+UCRED = struct.Struct("3i")
 
-def read_one(channel):
-    with open_channel(channel, "r", 1) as fifo:
+# Channels created by this process, by name
+channels = {}
+
+def socket_for(channel):
+    return BASE_DIR + "waydroid-" + channel + ".sock"
+
+def send_message(sock, data):
+    packet = HEADER.pack(len(data)) + data[:MAX_PACKET - HEADER.size]
+    sock.sendall(packet)
+    for offset in range(MAX_PACKET - HEADER.size, len(data), MAX_PACKET):
+        sock.sendall(data[offset:offset + MAX_PACKET])
+
+def recv_message(sock):
+    """ :returns: the next message, or None once the other end closed """
+    packet = sock.recv(MAX_PACKET)
+    if len(packet) < HEADER.size:
+        return None
+    length = HEADER.unpack_from(packet)[0]
+    parts = [packet[HEADER.size:]]
+    received = len(parts[0])
+    while received < length:
+        packet = sock.recv(MAX_PACKET)
+        if not packet:
+            return None
+        parts.append(packet)
+        received += len(packet)
+    return b"".join(parts)
+
+class Channel:
+    """ Publishing end of a channel. A listening socket created by another
+        process (e.g. the parent of a worker) can be passed as listener.
+        Subscribers are let in by the uid they connect with: root, and the
+        users in uids. """
+    def __init__(self, name, listener=None, uids=()):
+        self.name = name
+        self.uids = {0, *uids}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.owner = listener is None
+        if listener is None:
+            path = socket_for(name)
+            if os.path.exists(path):
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            listener.bind(path)
+            # Anyone may connect, accept_pending() checks who it is
+            os.chmod(path, 0o666)
+            listener.listen()
+        # Several processes may share the listener, never block in accept()
+        listener.setblocking(False)
+        self.listener = listener
+
+    def fileno(self):
+        return self.listener.fileno()
+
+    def accept_pending(self):
+        """ Take in the subscribers waiting to be accepted. Call with lock """
+        while select.select([self.listener], [], [], 0)[0]:
+            try:
+                sock, _ = self.listener.accept()
+            except BlockingIOError:
+                break
+            _, uid, _ = UCRED.unpack(sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED.size))
+            if uid not in self.uids:
+                sock.close()
+                continue
+            sock.settimeout(SEND_TIMEOUT)
+            self.subscribers.append(sock)
+
+    def drop(self, sock):
+        self.subscribers.remove(sock)
+        sock.close()
+
+    def drop_closed(self):
+        """ Drop the subscribers that already hung up. Call with lock """
+        poller = select.poll()
+        for sock in self.subscribers:
+            poller.register(sock, select.POLLRDHUP)
+        for fd, _ in poller.poll(0):
+            self.drop(next(s for s in self.subscribers if s.fileno() == fd))
+
+    def discard_pending(self):
+        """ Close the connections waiting to be accepted, for a listener
+            shared with worker processes once the worker that would have
+            served them is gone """
+        with self.lock:
+            self.accept_pending()
+            for sock in list(self.subscribers):
+                self.drop(sock)
+
+    def wait_subscriber(self, timeout=None):
+        """ :returns: True once there is a subscriber, False on timeout """
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
-            data = fifo.read()
-            if len(data) != 0:
-                return data
+            with self.lock:
+                self.accept_pending()
+                # Connections left in the backlog by subscribers that gave
+                # up don't count
+                self.drop_closed()
+                if self.subscribers:
+                    return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            select.select([self.listener], [], [], remaining)
+
+    def wait_idle(self):
+        """ Block until every subscriber is gone """
+        while True:
+            with self.lock:
+                self.drop_closed()
+                if not self.subscribers:
+                    return
+                poller = select.poll()
+                for sock in self.subscribers:
+                    poller.register(sock, select.POLLRDHUP)
+            poller.poll(1000)
+
+    def publish(self, msg):
+        """ :returns: count of subscribers the message was delivered to """
+        if isinstance(msg, str):
+            msg = msg.encode()
+        with self.lock:
+            self.accept_pending()
+            for sock in list(self.subscribers):
+                try:
+                    send_message(sock, msg)
+                except OSError:
+                    # Gone, or stuck for longer than SEND_TIMEOUT
+                    self.drop(sock)
+            return len(self.subscribers)
+
+    def close(self):
+        with self.lock:
+            for sock in list(self.subscribers):
+                self.drop(sock)
+        self.listener.close()
+        if self.owner and channels.get(self.name) is self:
+            del channels[self.name]
+            if os.path.exists(socket_for(self.name)):
+                os.unlink(socket_for(self.name))
+
+class Subscription:
+    """ Receiving end of a channel """
+    def __init__(self, name):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(socket_for(name))
+        self.watch_id = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self):
+        return recv_message(self.sock)
+
+    def __iter__(self):
+        return iter(self.recv, None)
+
+    def watch(self, callback):
+        """ Call callback with each message from the GLib main loop, then
+            with None once the publisher is gone """
+        def on_ready(fd, condition):
+            msg = self.recv() if condition & GLib.IO_IN else None
+            if msg is None:
+                self.watch_id = None
+            callback(msg)
+            return msg is not None
+        self.watch_id = GLib.io_add_watch(
+            self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, on_ready)
+
+    def close(self):
+        if self.watch_id is not None:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_one(channel):
+    with open_channel(channel) as subscription:
+        msg = subscription.recv()
+    return msg.decode() if msg is not None else ""
 
 def create_channel(channel):
-    pipe = pipe_for(channel)
-    if not os.path.exists(pipe):
-        os.mkfifo(pipe)
+    if channel not in channels:
+        channels[channel] = Channel(channel)
+    return channels[channel]
 
-def open_channel(channel, mode, buffering=0):
-    return open(pipe_for(channel), mode, buffering)
+def open_channel(channel):
+    return Subscription(channel)
 
 def notify(channel, msg):
-    try:
-        fd = os.open(pipe_for(channel), os.O_WRONLY | os.O_NONBLOCK)
-        with os.fdopen(fd, "w") as fifo:
-            fifo.write(msg)
-    except Exception:
-        pass
+    """ Publish on a channel of this process, if anyone is listening.
+
+        :returns: count of subscribers reached """
+    if channel not in channels:
+        return 0
+    return channels[channel].publish(msg)
 
 def notify_blocking(channel, msg):
-    with open_channel(channel, "w", 1) as channel:
-        channel.write(msg)
+    create_channel(channel).wait_subscriber()
+    notify(channel, msg)
+
+# Proxies of this process, by bus, name, object path and interface. They
+# skip introspection and address the well-known name, so they survive the
+# service restarting and creating one costs no bus round trip.
+proxies = {}
+
+def get_proxy(bus, name, object_path, intf):
+    key = (bus, name, object_path, intf)
+    if key not in proxies:
+        conn = dbus.SystemBus() if bus == "system" else dbus.SessionBus()
+        proxies[key] = dbus.Interface(conn.get_object(
+            name, object_path, introspect=False, follow_name_owner_changes=True), intf)
+    return proxies[key]
+
+def session_running():
+    """ Liveness check of the user session service, without a proxy """
+    try:
+        return bool(dbus.SessionBus().name_has_owner("id.waydro.Session"))
+    except dbus.DBusException:
+        return False
+
+def container_running():
+    """ Liveness check of the container service, without a proxy """
+    try:
+        return bool(dbus.SystemBus().name_has_owner("id.waydro.Container"))
+    except dbus.DBusException:
+        return False
+
+@contextlib.contextmanager
+def unfrozen_session():
+    """ Unfreeze the container for the duration of the block if it is frozen,
+        and freeze it again after. Raises dbus.DBusException or KeyError when
+        the session is stopped.
+
+        :returns: the session, as reported by the container manager """
+    if not session_running():
+        raise KeyError("id.waydro.Session")
+    cm = DBusContainerService()
+    session = cm.GetSessionState(True)
+    # Empty when the session stopped since session_running()
+    if "state" not in session:
+        raise KeyError("id.waydro.Session")
+    try:
+        yield session
+    finally:
+        if session["state"] == "FROZEN":
+            cm.Freeze()
 
 def DBusContainerService(object_path="/ContainerManager", intf="id.waydro.ContainerManager"):
-    return dbus.Interface(dbus.SystemBus().get_object("id.waydro.Container", object_path), intf)
+    return get_proxy("system", "id.waydro.Container", object_path, intf)
 
 def DBusSessionService(object_path="/SessionManager", intf="id.waydro.SessionManager"):
-    return dbus.Interface(dbus.SessionBus().get_object("id.waydro.Session", object_path), intf)
+    return get_proxy("session", "id.waydro.Session", object_path, intf)
@@ -428,10 +428,10 @@ def make_base_props(args):
         except:
             return False
 
-    props = []
+    host = {}
 
     if not os.path.exists("/dev/ashmem"):
-        props.append("sys.use_memfd=true")
+        host["sys.use_memfd"] = "true"
 
     egl = tools.helpers.props.host_get(args, "ro.hardware.egl")
     dri, _ = tools.helpers.gpu.getDriNode(args)
@@ -444,92 +444,88 @@ def make_base_props(args):
         if dri:
             gralloc = "gbm"
             egl = "mesa"
-            props.append("gralloc.gbm.device=" + dri)
+            host["gralloc.gbm.device"] = dri
         else:
             gralloc = "default"
             egl = "swiftshader"
-        props.append("debug.stagefright.ccodec=0")
-    props.append("ro.hardware.gralloc=" + gralloc)
+        host["debug.stagefright.ccodec"] = "0"
+    host["ro.hardware.gralloc"] = gralloc
 
     if egl != "":
-        props.append("ro.hardware.egl=" + egl)
+        host["ro.hardware.egl"] = egl
 
     media_profiles = tools.helpers.props.host_get(args, "media.settings.xml")
     if media_profiles != "":
         media_profiles = media_profiles.replace("vendor/", "vendor_extra/")
         media_profiles = media_profiles.replace("odm/", "odm_extra/")
-        props.append("media.settings.xml=" + media_profiles)
+        host["media.settings.xml"] = media_profiles
 
     ccodec = tools.helpers.props.host_get(args, "debug.stagefright.ccodec")
     if ccodec != "":
-        props.append("debug.stagefright.ccodec=" + ccodec)
+        host["debug.stagefright.ccodec"] = ccodec
 
     ext_library = tools.helpers.props.host_get(args, "ro.vendor.extension_library")
     if ext_library != "":
         ext_library = ext_library.replace("vendor/", "vendor_extra/")
         ext_library = ext_library.replace("odm/", "odm_extra/")
-        props.append("ro.vendor.extension_library=" + ext_library)
+        host["ro.vendor.extension_library"] = ext_library
 
     vulkan = find_hal("vulkan")
     if not vulkan and dri:
         vulkan = tools.helpers.gpu.getVulkanDriver(args, os.path.basename(dri))
     if vulkan:
-        props.append("ro.hardware.vulkan=" + vulkan)
+        host["ro.hardware.vulkan"] = vulkan
 
     treble = tools.helpers.props.host_get(args, "ro.treble.enabled")
     if treble != "true":
         camera = find_hal("camera")
         if camera != "":
-            props.append("ro.hardware.camera=" + camera)
+            host["ro.hardware.camera"] = camera
         else:
             if args.vendor_type == "MAINLINE":
-                props.append("ro.hardware.camera=v4l2")
+                host["ro.hardware.camera"] = "v4l2"
 
     opengles = tools.helpers.props.host_get(args, "ro.opengles.version")
     if opengles == "":
         opengles = "196610"
-    props.append("ro.opengles.version=" + opengles)
+    host["ro.opengles.version"] = opengles
 
+    image = {}
     if args.images_path not in tools.config.defaults["preinstalled_images_paths"]:
-        props.append("waydroid.system_ota=" + args.system_ota)
-        props.append("waydroid.vendor_ota=" + args.vendor_ota)
+        image["waydroid.system_ota"] = args.system_ota
+        image["waydroid.vendor_ota"] = args.vendor_ota
     else:
-        props.append("waydroid.updater.disabled=true")
+        image["waydroid.updater.disabled"] = "true"
 
-    props.append("waydroid.tools_version=" + tools.config.version)
+    image["waydroid.tools_version"] = tools.config.version
 
     if args.vendor_type == "MAINLINE":
-        props.append("ro.vndk.lite=true")
+        image["ro.vndk.lite"] = "true"
 
     for product in ["brand", "device", "manufacturer", "model", "name"]:
         prop_product = tools.helpers.props.host_get(
             args, "ro.product.vendor." + product)
         if prop_product != "":
-            props.append("ro.product.waydroid." + product + "=" + prop_product)
+            host["ro.product.waydroid." + product] = prop_product
         else:
             if os.path.isfile("/proc/device-tree/" + product):
                 with open("/proc/device-tree/" + product) as f:
                     f_value = f.read().strip().rstrip('\x00')
                     if f_value != "":
-                        props.append("ro.product.waydroid." +
-                                     product + "=" + f_value)
+                        host["ro.product.waydroid." + product] = f_value
 
     prop_fp = tools.helpers.props.host_get(args, "ro.vendor.build.fingerprint")
     if prop_fp != "":
-        props.append("ro.build.fingerprint=" + prop_fp)
+        host["ro.build.fingerprint"] = prop_fp
 
-    # now append/override with values in [properties] section of waydroid.cfg
+    # [properties] in waydroid.cfg override everything else
     cfg = tools.config.load(args)
-    for k, v in cfg["properties"].items():
-        for idx, elem in enumerate(props):
-            if (k+"=") in elem:
-                props.pop(idx)
-        props.append(k+"="+v)
-
-    base_props = open(args.work + "/waydroid_base.prop", "w")
-    for prop in props:
-        base_props.write(prop + "\n")
-    base_props.close()
+    layers = tools.helpers.props.Layers()
+    layers.add("host", host)
+    layers.add("image", image)
+    layers.add("config", cfg["properties"])
+    layers.write(args.work + "/waydroid_base.prop")
+    return layers
 
 
 def setup_host_perms(args):
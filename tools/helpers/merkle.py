@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+
+# Chunked Merkle manifests of images.
+#
+# A manifest uses the same layout as the chunk manifests of delta updates,
+# plus the Merkle root over the chunk digests:
+#
+#     {
+#         "size": <image size in bytes>,
+#         "chunk_size": <bytes per chunk>,
+#         "chunks": ["<sha256 of chunk 0>", ...],
+#         "root": "<sha256 Merkle root of the chunks>"
+#     }
+#
+# Images on disk are hashed from an mmap on every core, hashlib releases
+# the GIL for buffers this large. Images being written are hashed as they
+# go with a Hasher.
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def root(chunks):
+    """ Hash pairs of digests up to a single root. An odd digest out is
+        carried up to the next level unchanged. """
+    level = [bytes.fromhex(digest) for digest in chunks]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level)
+                 else level[i] for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+def hash_chunks(path, chunk_size, indexes=None, reporter=None):
+    """ :returns: dict of chunk index to sha256, for all chunks of path or
+                  only the ones in indexes """
+    size = os.path.getsize(path)
+    count = -(-size // chunk_size)
+    if indexes is None:
+        indexes = range(count)
+    if size == 0:
+        return {}
+
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mapped:
+        view = memoryview(mapped)
+
+        def work(i):
+            with view[i * chunk_size:(i + 1) * chunk_size] as chunk:
+                digest = hashlib.sha256(chunk).hexdigest()
+                if reporter:
+                    reporter.advance(len(chunk))
+            return i, digest
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+                return dict(pool.map(work, [i for i in indexes if i < count]))
+        finally:
+            view.release()
+
+class Hasher:
+    """ Chunk digests of data fed in order, to make the manifest of an image
+        in the same pass that writes it instead of reading it back """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.current = hashlib.sha256()
+        self.filled = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.chunk_size - self.filled)
+            self.current.update(view[:n])
+            self.filled += n
+            self.size += n
+            view = view[n:]
+            if self.filled == self.chunk_size:
+                self.chunks.append(self.current.hexdigest())
+                self.current = hashlib.sha256()
+                self.filled = 0
+
+    def manifest(self):
+        chunks = self.chunks + ([self.current.hexdigest()] if self.filled else [])
+        return {"size": self.size, "chunk_size": self.chunk_size, "chunks": chunks,
+                "root": root(chunks)}
+
+def build(path, chunk_size=CHUNK_SIZE, reporter=None):
+    size = os.path.getsize(path)
+    digests = hash_chunks(path, chunk_size, reporter=reporter)
+    chunks = [digests[i] for i in range(len(digests))]
+    return {"size": size, "chunk_size": chunk_size, "chunks": chunks,
+            "root": root(chunks)}
+
+def verify(path, manifest, indexes=None, reporter=None):
+    """ Compare path with its manifest.
+
+        :param indexes: only rehash these chunks, for example the ones that
+                        were rewritten since the manifest was made
+        :returns: list of the chunk indexes that don't match """
+    if os.path.getsize(path) != manifest["size"] or \
+            root(manifest["chunks"]) != manifest["root"]:
+        return list(range(len(manifest["chunks"])))
+    digests = hash_chunks(path, manifest["chunk_size"], indexes, reporter)
+    return sorted(i for i, digest in digests.items() if digest != manifest["chunks"][i])
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
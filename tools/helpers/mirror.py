@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import http.server
+import json
+import logging
+import os
+import re
+import urllib.parse
+import tools.config
+from tools import helpers
+
+# LAN mirror of the local image store.
+#
+# Serves the OTA channels this machine uses at the same paths as upstream,
+# rewritten to list only builds whose channel zip is kept in the store
+# (store_keep_zips = True), and those zips under /files/. Other machines
+# point their system and vendor channels at the mirror instead of the
+# upstream server; their downloads are still checked against the build
+# ids from the channel.
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def channel_builds(args, cfg, kind, base_url):
+    """ :returns: channel document listing the kept builds of kind, newest
+                  first, with their url pointing at this mirror """
+    upstream = {}
+    request = helpers.http.retrieve_json(args, cfg["waydroid"][kind + "_ota"])
+    if request[0] == 200:
+        upstream = {build["id"]: build for build in request[1]["response"]}
+
+    builds = []
+    for meta in helpers.store.entries(args, kind):
+        if not helpers.store.kept_zip(args, kind, meta["id"]):
+            continue
+        build = dict(upstream.get(meta["id"], {
+            "id": meta["id"], "datetime": meta["datetime"], "filename": meta.get("filename", "")}))
+        build.pop("chunks", None)
+        build["url"] = "{}/files/{}/{}/{}".format(
+            base_url, kind, meta["id"], build["filename"] or helpers.store.KEPT_ZIP)
+        builds.append(build)
+    builds.sort(key=lambda build: build["datetime"], reverse=True)
+    return {"response": builds}
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    args = None
+
+    def log_message(self, format, *log_args):
+        logging.debug("{} {}".format(self.address_string(), format % log_args))
+
+    def send_json(self, document):
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+        elif match and match.group(2):
+            # Suffix range: the last n bytes
+            start = max(size - int(match.group(2)), 0)
+        elif match:
+            # "bytes=-" names no bytes at all
+            start = end
+        if match and start >= end:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        self.wfile.flush()
+        with open(path, "rb") as f:
+            # Straight from the page cache to the socket
+            self.connection.sendfile(f, start, end - start)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        cfg = tools.config.load(self.args)
+        base_url = "http://" + self.headers.get("Host", "{}:{}".format(*self.server.server_address[:2]))
+
+        for kind in helpers.store.KINDS:
+            if path == urllib.parse.urlsplit(cfg["waydroid"][kind + "_ota"]).path:
+                return self.send_json(channel_builds(self.args, cfg, kind, base_url))
+
+        parts = path.strip("/").split("/")
+        if len(parts) == 4 and parts[0] == "files" and parts[1] in helpers.store.KINDS \
+                and re.fullmatch(r"[0-9a-f]{64}", parts[2]):
+            zip_path = helpers.store.kept_zip(self.args, parts[1], parts[2])
+            if zip_path:
+                return self.send_file(zip_path)
+        self.send_error(404)
+
+    do_HEAD = do_GET
+
+def serve(args, address, port):
+    cfg = tools.config.load(args)
+    if cfg["waydroid"]["store_keep_zips"] != "True":
+        logging.warning("store_keep_zips is not enabled, only images downloaded"
+                        " while it was will be served")
+
+    handler = type("Handler", (MirrorHandler,), {"args": args})
+    server = http.server.ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    host = "{}:{}".format(*server.server_address[:2])
+    for kind in helpers.store.KINDS:
+        ota = urllib.parse.urlsplit(cfg["waydroid"][kind + "_ota"])
+        logging.info("Serving {} channel at http://{}{}".format(kind, host, ota.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
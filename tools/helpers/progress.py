@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import sys
+import threading
+import time
+
+# Progress of long running image operations, published as events.
+#
+# The download, verify and extract stages create a Reporter and tell it
+# how far they got. Reporters turn that into event dicts with the keys
+# phase, name, bytes, total, rate (bytes/s) and eta (seconds), and hand
+# them to every subscriber, at most once per MIN_INTERVAL for each phase
+# plus once when it is done.
+
+MIN_INTERVAL = 0.2
+
+subscribers = []
+
+def subscribe(callback):
+    subscribers.append(callback)
+
+def unsubscribe(callback):
+    if callback in subscribers:
+        subscribers.remove(callback)
+
+def publish(event):
+    for callback in list(subscribers):
+        callback(event)
+
+class Reporter:
+    def __init__(self, phase, total, name=""):
+        self.phase = phase
+        self.name = name
+        self.total = int(total or 0)
+        self.done = 0
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last = 0
+
+    def advance(self, count):
+        with self.lock:
+            self.done += count
+            self.maybe_publish()
+
+    def update(self, done):
+        with self.lock:
+            self.done = done
+            self.maybe_publish()
+
+    def maybe_publish(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last < MIN_INTERVAL and self.done != self.total:
+            return
+        self.last = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate > 0 and self.total else 0
+        publish({"phase": self.phase, "name": self.name, "bytes": self.done,
+                 "total": self.total, "rate": rate, "eta": eta})
+
+    def finish(self):
+        with self.lock:
+            if self.done != self.total:
+                # Size wasn't known up front, or the stage stopped early
+                self.total = self.done
+                self.maybe_publish(force=True)
+
+def render_terminal(event):
+    """ Draw events as a progress line, when stdout is a terminal. """
+    if not getattr(sys.stdout, "isatty", lambda: False)():
+        return
+    label = {"download": "Downloading", "verify": "Verifying",
+             "extract": "Extracting"}.get(event["phase"], event["phase"])
+    line = "\r[{}] {:.2f} MB/{:.2f} MB    {:7.2f} MB/s".format(
+        label, event["bytes"] / 1000000, event["total"] / 1000000, event["rate"] / 1000000)
+    if event["eta"]:
+        line += "    ETA {:.0f}s".format(event["eta"])
+    end = "\n" if event["total"] and event["bytes"] >= event["total"] else ""
+    print(line.ljust(70), end=end, flush=True)
+
+subscribe(render_terminal)
@@ -3,6 +3,8 @@
 from shutil import which
 import subprocess
 import logging
+import os
+import tools.config
 import tools.helpers.run
 from tools.interfaces import IPlatform
 
@@ -33,6 +35,44 @@ def set(args, prop, value):
     else:
         logging.error("Failed to access IPlatform service")
 
+def get_many(args, keys):
+    """ Read several properties over one IPlatform client.
+
+        :returns: dict of key to value, or None without the service """
+    platformService = IPlatform.get_service(args)
+    if not platformService:
+        logging.error("Failed to access IPlatform service")
+        return None
+    return {key: platformService.getprop(key, "") for key in keys}
+
+def set_many(args, props):
+    """ Set several properties over one IPlatform client.
+
+        :returns: False without the service """
+    platformService = IPlatform.get_service(args)
+    if not platformService:
+        logging.error("Failed to access IPlatform service")
+        return False
+    for key, value in props.items():
+        platformService.setprop(key, value)
+    return True
+
+def dump(args, prefix=""):
+    """ :returns: dict of every property in the container starting with
+                  prefix, read with one getprop run """
+    command = ["lxc-attach", "-P", tools.config.defaults["lxc"],
+               "-n", "waydroid", "--clear-env", "--", "/system/bin/getprop"]
+    output = tools.helpers.run.user(args, command, output_return=True)
+    props = {}
+    for line in output.splitlines():
+        # [key]: [value]
+        key, sep, value = line.partition("]: [")
+        if sep and key.startswith("[") and value.endswith("]"):
+            key = key[1:]
+            if key.startswith(prefix):
+                props[key] = value[:-1]
+    return props
+
 def file_get(args, file, prop):
     with open(file) as build_prop:
         for line in build_prop:
@@ -43,3 +83,80 @@ def file_get(args, file, prop):
             if k == prop:
                 return v
     return ""
+
+# Parsed property files, as path: (cache key, properties)
+file_props_cache = {}
+
+def parse(text):
+    props = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line[0] == "#":
+            continue
+        k, v = line.partition("=")[::2]
+        props[k] = v
+    return props
+
+def file_props(args, file, cache_key=None):
+    """ Read all properties of a file like build.prop at once.
+
+        :param cache_key: something that changes whenever the file does, like
+                          the datetime of the image it comes from. The file
+                          is parsed again only when it or its mtime change.
+        :returns: dict of property to value, the last definition winning """
+    key = (cache_key, os.stat(file).st_mtime_ns)
+    if cache_key is not None and file in file_props_cache and \
+            file_props_cache[file][0] == key:
+        return file_props_cache[file][1]
+    with open(file) as f:
+        props = parse(f.read())
+    file_props_cache[file] = (key, props)
+    return props
+
+class Layers:
+    """ Properties merged from ordered layers, such as "host", "image",
+        "config" and "session". A layer overrides the values of the layers
+        added before it, except for the read-only ones it is told to keep.
+        The layer each value came from is kept for the debug log. """
+    def __init__(self):
+        self.values = {}
+        self.origin = {}
+
+    def add(self, layer, props, keep_ro=False):
+        """ :param keep_ro: leave ro.* properties that an earlier layer
+                            set alone, like Android does when a property
+                            file defines them twice """
+        for k, v in props.items():
+            if keep_ro and k.startswith("ro.") and k in self.values:
+                if self.values[k] != v:
+                    logging.debug("Property {}={} from {} is kept over {}={} from {}".format(
+                        k, self.values[k], self.origin[k], k, v, layer))
+                continue
+            self.set(layer, k, v)
+
+    def set(self, layer, key, value):
+        if key in self.origin and self.origin[key] != layer:
+            logging.debug("Property {}={} from {} overrides {}={} from {}".format(
+                key, value, layer, key, self.values[key], self.origin[key]))
+        self.values[key] = value
+        self.origin[key] = layer
+
+    def render(self):
+        return "".join(k + "=" + v + "\n" for k, v in self.values.items())
+
+    def write(self, file, mode=0o644):
+        """ Write the merged properties to file, unless it already has them.
+            The file is rewritten in place, since it may be bind mounted.
+
+            :returns: True if the file was written """
+        content = self.render()
+        try:
+            with open(file) as f:
+                if f.read() == content:
+                    return False
+        except OSError:
+            pass
+        with open(file, "w") as f:
+            f.write(content)
+        os.chmod(file, mode)
+        return True
@@ -7,9 +7,10 @@ def set_aidl_version(args):
     cfg = tools.config.load(args)
     android_api = 0
     try:
-        android_api = int(helpers.props.file_get(args,
+        build_props = helpers.props.file_props(args,
                 tools.config.defaults["rootfs"] + "/system/build.prop",
-                "ro.build.version.sdk"))
+                cache_key=cfg["waydroid"]["system_datetime"])
+        android_api = int(build_props["ro.build.version.sdk"])
     except:
         logging.error("Failed to parse android version from system.img")
 
@@ -29,6 +30,9 @@ def set_aidl_version(args):
         binder_protocol = "aidl3"
         sm_protocol =     "aidl3"
 
+    if cfg["waydroid"].get("binder_protocol") == binder_protocol and \
+            cfg["waydroid"].get("service_manager_protocol") == sm_protocol:
+        return
     cfg["waydroid"]["binder_protocol"] = binder_protocol
     cfg["waydroid"]["service_manager_protocol"] = sm_protocol
     tools.config.save(args, cfg)
@@ -0,0 +1,298 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import tools.config
+import tools.helpers.images
+import tools.helpers.merkle
+
+# Content-addressed image store.
+#
+# Every image version lives in $WORK/store/<kind>/<id>/, where kind is
+# "system" or "vendor" and id is the sha256 of the channel zip it came
+# from. images_path/<kind>.img is a symlink to the active version, and is
+# swapped atomically, so going back to an older version is a rename.
+
+KINDS = ["system", "vendor"]
+
+# Chunk manifest of the image in each entry, see tools.helpers.merkle
+MANIFEST = "merkle.json"
+# The channel zip an entry came from, with store_keep_zips = True
+KEPT_ZIP = "images.zip"
+
+def store_dir(args, kind):
+    return os.path.join(args.work, "store", kind)
+
+def entry_dir(args, kind, id):
+    return os.path.join(store_dir(args, kind), id)
+
+def image_path(args, kind, id):
+    return os.path.join(entry_dir(args, kind, id), kind + ".img")
+
+def has(args, kind, id):
+    return os.path.isfile(image_path(args, kind, id))
+
+def kept_zip(args, kind, id):
+    """ :returns: path of the channel zip of a version, or None """
+    path = os.path.join(entry_dir(args, kind, id), KEPT_ZIP)
+    return path if os.path.isfile(path) else None
+
+def keep_zip(args, staging, images_zip):
+    """ Move an extracted channel zip into its staging directory when
+        store_keep_zips is set, so it can be served by waydroid mirror,
+        or delete it. """
+    if tools.config.load(args)["waydroid"]["store_keep_zips"] == "True":
+        shutil.move(images_zip, os.path.join(staging, KEPT_ZIP))
+    else:
+        os.remove(images_zip)
+
+def read_meta(args, kind, id):
+    try:
+        with open(os.path.join(entry_dir(args, kind, id), "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"id": id, "datetime": 0, "last_used": 0, "last_active": 0}
+
+def write_meta(args, kind, id, meta):
+    path = os.path.join(entry_dir(args, kind, id), "meta.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def entries(args, kind):
+    """ :returns: metadata of every stored version, most recently used first """
+    try:
+        ids = [id for id in os.listdir(store_dir(args, kind))
+               if not id.endswith(".tmp") and has(args, kind, id)]
+    except FileNotFoundError:
+        return []
+    return sorted((read_meta(args, kind, id) for id in ids),
+                  key=lambda meta: meta["last_used"], reverse=True)
+
+@contextlib.contextmanager
+def locked(args, kind, id, wait=True):
+    """ Keep other processes, like the background upgrade stager and
+        waydroid upgrade, from importing the same version at once. Waiting
+        for the lock asks its holder to give way, see yield_requested().
+
+        :yields: True once the lock is held, or False if wait is False and
+                 another process has it """
+    os.makedirs(store_dir(args, kind), exist_ok=True)
+    fd = os.open(entry_dir(args, kind, id) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                yield False
+                return
+            logging.info("Waiting for {} image {} to be imported by another process".format(kind, id))
+            with open(yield_path(args, kind, id), "w"):
+                pass
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            finally:
+                if os.path.exists(yield_path(args, kind, id)):
+                    os.remove(yield_path(args, kind, id))
+        yield True
+    finally:
+        os.close(fd)
+
+def yield_path(args, kind, id):
+    return entry_dir(args, kind, id) + ".yield"
+
+def yield_requested(args, kind, id):
+    """ :returns: True if a process is waiting in locked() for the version
+                  this one is importing in the background """
+    return os.path.exists(yield_path(args, kind, id))
+
+def staging_dir(args, kind, id):
+    """ Create an empty directory to build a new version in, to be handed
+        over to commit() once it holds a verified image. """
+    path = entry_dir(args, kind, id) + ".tmp"
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+def commit(args, kind, build, path, manifest=None):
+    """ Move a staging directory into the store under the build id.
+
+        :param manifest: chunk manifest of the image if it was hashed while
+                         being written, otherwise one already in the staging
+                         directory is kept or a new one is built """
+    if not os.path.isfile(os.path.join(path, kind + ".img")):
+        shutil.rmtree(path)
+        raise ValueError("{} image missing from {}".format(kind, build.get("filename", build["id"])))
+    if os.path.isdir(entry_dir(args, kind, build["id"])):
+        shutil.rmtree(entry_dir(args, kind, build["id"]))
+    if manifest is not None:
+        tools.helpers.merkle.save(os.path.join(path, MANIFEST), manifest)
+    elif not os.path.isfile(os.path.join(path, MANIFEST)):
+        tools.helpers.merkle.save(os.path.join(path, MANIFEST),
+                                  tools.helpers.merkle.build(os.path.join(path, kind + ".img")))
+    os.rename(path, entry_dir(args, kind, build["id"]))
+    # Enabling fs-verity has the kernel read the image once more, right
+    # after it was written so mostly from the page cache
+    write_meta(args, kind, build["id"], {
+        "id": build["id"],
+        "datetime": int(build["datetime"]),
+        "filename": build.get("filename", ""),
+        "last_used": time.time(),
+        "last_active": 0,
+        "verity": tools.helpers.images.verity_seal(image_path(args, kind, build["id"])),
+    })
+
+def manifest_path(args, kind, id):
+    return os.path.join(entry_dir(args, kind, id), MANIFEST)
+
+def check(args, kind, id):
+    """ Make sure a stored image is still the one that was committed. This
+        only reads the fs-verity digest, so versions stored on a filesystem
+        without fs-verity are trusted as they are. """
+    expected = read_meta(args, kind, id).get("verity")
+    if not expected:
+        return
+    if tools.helpers.images.verity_measure(image_path(args, kind, id)) != expected:
+        raise ValueError("{} image {} in the store is corrupted".format(kind, id))
+
+def active(args, kind, images_path):
+    """ :returns: id of the version images_path points to, or None """
+    link = os.path.join(images_path, kind + ".img")
+    if not os.path.islink(link):
+        return None
+    target = os.path.realpath(link)
+    if os.path.dirname(os.path.dirname(target)) != os.path.realpath(store_dir(args, kind)):
+        return None
+    return os.path.basename(os.path.dirname(target))
+
+def adopt(args, kind, images_path, datetime):
+    """ Move an image installed before the store existed into it, so it can
+        be rolled back to. """
+    path = os.path.join(images_path, kind + ".img")
+    if os.path.islink(path) or not os.path.isfile(path):
+        return
+    id = "legacy-" + str(datetime)
+    os.makedirs(store_dir(args, kind), exist_ok=True)
+    staging = staging_dir(args, kind, id)
+    try:
+        os.rename(path, os.path.join(staging, kind + ".img"))
+        copied = False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            shutil.rmtree(staging)
+            raise
+        # Different filesystem. The image is only removed once its copy is
+        # in the store, activating the store version replaces it anyway.
+        logging.info("Copying {} into the image store".format(path))
+        try:
+            copy_sparse(path, os.path.join(staging, kind + ".img"))
+        except:
+            shutil.rmtree(staging)
+            raise
+        copied = True
+    commit(args, kind, {"id": id, "datetime": datetime}, staging)
+    if copied:
+        os.remove(path)
+    activate(args, kind, id, images_path)
+
+def copy_sparse(src, dest):
+    """ Copy src to dest and flush it to disk, leaving all-zero blocks as
+        holes like tools.helpers.images.extract_member() """
+    zero = bytes(tools.helpers.images.SPARSE_BLOCK_SIZE)
+    with open(src, "rb", buffering=0) as f_src, open(dest, "wb", buffering=0) as f_dest:
+        for block in iter(lambda: f_src.read(len(zero)), b""):
+            if block == zero[:len(block)]:
+                f_dest.seek(len(block), os.SEEK_CUR)
+            else:
+                f_dest.write(block)
+        f_dest.truncate()
+        os.fsync(f_dest.fileno())
+
+def activate(args, kind, id, images_path):
+    """ Point images_path/<kind>.img at a stored version.
+
+        :returns: True if the active version changed """
+    check(args, kind, id)
+    meta = read_meta(args, kind, id)
+    meta["last_used"] = meta["last_active"] = time.time()
+    write_meta(args, kind, id, meta)
+    if active(args, kind, images_path) == id:
+        return False
+
+    os.makedirs(images_path, exist_ok=True)
+    link = os.path.join(images_path, kind + ".img")
+    tmp_link = os.path.join(images_path, "." + kind + ".img.new")
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(image_path(args, kind, id), tmp_link)
+    os.replace(tmp_link, link)
+    logging.info("Activated {} image {}".format(kind, id))
+    return True
+
+def entry_size(args, kind, id):
+    size = 0
+    for root, _, files in os.walk(entry_dir(args, kind, id)):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return size
+
+def evict(args, images_path):
+    """ Drop least recently used versions beyond store_versions per kind,
+        then more until the store fits store_budget_mb. The active versions
+        are always kept. """
+    cfg = tools.config.load(args)
+    keep = max(1, int(cfg["waydroid"]["store_versions"]))
+    budget = int(cfg["waydroid"]["store_budget_mb"]) * 1024 * 1024
+
+    candidates = []
+    total = 0
+    for kind in KINDS:
+        current = active(args, kind, images_path)
+        for n, meta in enumerate(entries(args, kind)):
+            size = entry_size(args, kind, meta["id"])
+            if meta["id"] == current:
+                total += size
+            elif n >= keep:
+                remove(args, kind, meta["id"])
+            else:
+                total += size
+                candidates.append((meta["last_used"], kind, meta["id"], size))
+
+    for _, kind, id, size in sorted(candidates):
+        if not budget or total <= budget:
+            break
+        remove(args, kind, id)
+        total -= size
+
+def remove(args, kind, id):
+    logging.info("Removing {} image {} from the store".format(kind, id))
+    shutil.rmtree(entry_dir(args, kind, id))
+    if os.path.exists(entry_dir(args, kind, id) + ".lock"):
+        os.remove(entry_dir(args, kind, id) + ".lock")
+
+def rollback(args, images_path):
+    """ Switch every kind back to its previously used version.
+
+        :returns: True if any version changed """
+    cfg = tools.config.load(args)
+    changed = False
+    for kind in KINDS:
+        current = active(args, kind, images_path)
+        previous = sorted((meta for meta in entries(args, kind)
+                           if meta["id"] != current and meta.get("last_active")),
+                          key=lambda meta: meta["last_active"], reverse=True)
+        if not previous:
+            logging.info("No older {} image to roll back to".format(kind))
+            continue
+        if activate(args, kind, previous[0]["id"], images_path):
+            cfg["waydroid"][kind + "_datetime"] = str(previous[0]["datetime"])
+            changed = True
+    if changed:
+        tools.config.save(args, cfg)
+    return changed
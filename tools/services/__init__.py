@@ -3,3 +3,5 @@
 from tools.services.user_manager import start, stop
 from tools.services.clipboard_manager import start, stop
 from tools.services.hardware_manager import start, stop
+from tools.services.memory_governor import start, stop
+from tools.services.upgrade_stager import start, stop
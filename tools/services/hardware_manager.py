@@ -19,6 +19,8 @@ def start(args):
         logging.debug("Function enableBluetooth not implemented")
 
     def suspend():
+        # Android suspends once none of its apps is on screen anymore
+        tools.actions.container_manager.set_active_apps(args, "")
         cfg = tools.config.load(args)
         if cfg["waydroid"]["suspend_action"] == "stop":
             tools.actions.session_manager.stop(args)
@@ -27,29 +29,40 @@ def start(args):
 
     def reboot():
         helpers.lxc.stop(args)
+        tools.actions.container_manager.set_state(args, "STOPPED")
         helpers.lxc.start(args)
+        tools.actions.container_manager.set_state(args, "RUNNING")
 
     def upgrade(system_zip, system_time, vendor_zip, vendor_time):
+        validated = {}
         if os.path.exists(system_zip):
-            if not helpers.images.validate(args, "system_ota", system_zip):
+            validated[system_zip] = helpers.images.validate(args, "system_ota", system_zip)
+            if not validated[system_zip]:
                 logging.warning("Not upgrading because system.img comes from an unverified source")
                 return
         else:
             system_zip = "" # Race prevention
         if os.path.exists(vendor_zip):
-            if not helpers.images.validate(args, "vendor_ota", vendor_zip):
+            validated[vendor_zip] = helpers.images.validate(args, "vendor_ota", vendor_zip)
+            if not validated[vendor_zip]:
                 logging.warning("Not upgrading because vendor.img comes from an unverified source")
                 return
         else:
             vendor_zip = "" # Race prevention
+        # Extract next to the active images while Android keeps running,
+        # the container is only down for the switch and a reboot. The
+        # previous versions stay in the store for upgrade --rollback.
+        staged = helpers.images.stage(args, system_zip, system_time,
+                                      vendor_zip, vendor_time, validated)
         helpers.lxc.stop(args)
+        tools.actions.container_manager.set_state(args, "STOPPED")
         helpers.images.umount_rootfs(args)
-        helpers.images.replace(args, system_zip, system_time,
-                               vendor_zip, vendor_time)
+        helpers.images.switch(args, staged)
         args.session["background_start"] = "false"
         helpers.images.mount_rootfs(args, args.images_path, args.session)
         helpers.protocol.set_aidl_version(args)
         helpers.lxc.start(args)
+        tools.actions.container_manager.set_state(args, "RUNNING")
 
     def service_thread():
         while not stopping:
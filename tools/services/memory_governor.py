@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+import tools.actions.container_manager
+import tools.actions.session_manager
+import tools.config
+from tools import helpers
+from gi.repository import GLib
+
+# Escalation steps, taken one at a time while memory pressure stays high
+LEVELS = ["normal", "trim", "freeze", "suspend"]
+
+# Ask every Android app process to drop its caches
+TRIM_SCRIPT = "for p in $(ps -A -o NAME= | grep '\\.'); do am send-trim-memory \"$p\" RUNNING_CRITICAL; done"
+# Seconds before giving up on the trim, e.g. if the container got frozen
+TRIM_TIMEOUT = 30
+
+def open_trigger(path, stall_us, window_us):
+    """ Register a PSI trigger, see Documentation/accounting/psi.rst.
+
+        :returns: file descriptor that polls POLLPRI whenever tasks stalled
+                  for more than stall_us within window_us, or None """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError as e:
+        logging.debug("Can't open {}: {}".format(path, e))
+        return None
+    try:
+        os.write(fd, "some {} {}\0".format(stall_us, window_us).encode())
+    except OSError as e:
+        logging.debug("Can't set PSI trigger on {}: {}".format(path, e))
+        os.close(fd)
+        return None
+    return fd
+
+def trim_memory(args):
+    command = ["lxc-attach", "-P", tools.config.defaults["lxc"],
+               "-n", "waydroid", "--clear-env"]
+    command.extend(helpers.lxc.android_env_attach_options(args))
+    command.extend(["--", "/system/bin/sh", "-c", TRIM_SCRIPT])
+    logging.debug("% " + " ".join(command))
+    try:
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=TRIM_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        logging.warning("Trimming memory took longer than {}s, gave up".format(TRIM_TIMEOUT))
+
+def in_background(args):
+    """ Android has no visible app, see container_manager.set_active_apps """
+    return tools.actions.container_manager.active_profile(args) == "background"
+
+def freeze(args):
+    """ Freeze the container, remembering that it was the governor's doing.
+        Any unfreeze clears that, see container_manager.unfreeze """
+    if helpers.lxc.status(args) == "RUNNING":
+        tools.actions.container_manager.freeze(args)
+        args.frozen_by_governor = True
+
+def thaw(args):
+    """ Undo freeze(), unless someone thawed the container since """
+    if getattr(args, "frozen_by_governor", False):
+        tools.actions.container_manager.unfreeze(args)
+
+def on_main_loop(func, *params):
+    """ Run a container action on the main loop, after any DBus call that is
+        being handled, like the ones from the session and hardware manager """
+    def run():
+        func(*params)
+        return False
+    GLib.idle_add(run)
+
+def escalate(args, level):
+    """ :returns: True if the container gets frozen """
+    logging.warning("Memory pressure is high, escalating to: " + LEVELS[level])
+    # Already suspended, and anything attached to it would freeze as well
+    frozen = helpers.lxc.status(args) == "FROZEN"
+    if LEVELS[level] == "trim":
+        if frozen:
+            logging.info("Container is frozen, not trimming")
+        else:
+            trim_memory(args)
+    elif not in_background(args):
+        # Never freeze or stop what the user is looking at
+        logging.info("Android is in the foreground, not going further than trimming")
+    elif LEVELS[level] == "freeze":
+        if frozen:
+            logging.info("Container is already frozen")
+        else:
+            on_main_loop(freeze, args)
+            return True
+    elif LEVELS[level] == "suspend":
+        cfg = tools.config.load(args)
+        if cfg["waydroid"]["suspend_action"] == "stop":
+            # Like hardware_manager's suspend, through the session. Not from
+            # this thread: stopping the container joins it.
+            threading.Thread(target=tools.actions.session_manager.stop,
+                             args=(args,), daemon=True).start()
+        else:
+            logging.info("Container is already frozen, nothing left to do")
+    return False
+
+def start(args):
+    cfg = tools.config.load(args)["resources"]
+    if cfg["psi_enabled"] != "True":
+        return
+    stall_us = int(cfg["psi_stall_us"])
+    window_us = int(cfg["psi_window_us"])
+    escalate_after = int(cfg["psi_escalate_after"])
+    recover_s = int(cfg["psi_recover_s"])
+
+    paths = ["/proc/pressure/memory"]
+    cgroup = helpers.cgroup.container_path(args)
+    if cgroup:
+        paths.append(cgroup + "/memory.pressure")
+    fds = [fd for fd in (open_trigger(p, stall_us, window_us) for p in paths) if fd is not None]
+    if not fds:
+        logging.info("PSI is not available, memory governor disabled")
+        return
+
+    stopping = threading.Event()
+
+    def service_thread():
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLPRI)
+        level = 0
+        events = 0
+        last_event = 0
+        frozen = False
+        try:
+            while not stopping.is_set():
+                ready = poller.poll(1000)
+                now = time.monotonic()
+                if not ready:
+                    if level > 0 and now - last_event > recover_s:
+                        logging.info("Memory pressure is back to normal")
+                        if frozen:
+                            on_main_loop(thaw, args)
+                            frozen = False
+                        level = 0
+                        events = 0
+                    continue
+                if any(ev & select.POLLERR for _, ev in ready):
+                    logging.debug("PSI trigger went away, stopping memory governor")
+                    break
+                last_event = now
+                events += 1
+                logging.debug("Memory pressure event {}/{} at level {}".format(
+                    events, escalate_after, LEVELS[level]))
+                if events >= escalate_after and level < len(LEVELS) - 1:
+                    events = 0
+                    level += 1
+                    frozen = escalate(args, level) or frozen
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    stop(args)
+    args.memory_governor_stopping = stopping
+    args.memory_governor = threading.Thread(target=service_thread)
+    args.memory_governor.daemon = True
+    args.memory_governor.start()
+
+def stop(args):
+    try:
+        args.memory_governor_stopping.set()
+        if args.memory_governor is not threading.current_thread():
+            args.memory_governor.join()
+    except AttributeError:
+        logging.debug("Memory governor is not even started")
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import copy
+import ctypes
+import logging
+import os
+import platform
+import threading
+import tools.actions.upgrader
+import tools.config
+from tools import helpers
+
+stopping = False
+wakeup = threading.Event()
+
+# ioprio_set(2) has no wrapper in libc
+IOPRIO_SET_SYSCALL = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "armv8l": 314,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def set_idle_priority():
+    """ Move the calling thread, and the threads it starts from then on, to
+        the idle CPU and IO scheduling classes. They only get CPU time and
+        disk bandwidth nobody else wants. """
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except OSError as e:
+        logging.debug("Failed to set SCHED_IDLE: {}".format(e))
+        os.nice(19)
+
+    syscall = IOPRIO_SET_SYSCALL.get(platform.machine())
+    if syscall is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0,
+                    IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        logging.debug("Failed to set idle IO priority: {}".format(
+            os.strerror(ctypes.get_errno())))
+
+def stage(args):
+    """ Import the builds a waydroid upgrade would install into the image
+        store, leaving the active images alone. """
+    cfg = tools.config.load(args)
+    max_rate = int(cfg["waydroid"]["prestage_max_rate_kb"]) * 1024
+    for kind in helpers.store.KINDS:
+        build = helpers.images.channel_update(args, cfg, kind)
+        if build is None or helpers.store.has(args, kind, build["id"]):
+            continue
+        logging.info("Staging {} image {} in the background".format(kind, build["id"]))
+        if not helpers.images.fetch(args, kind, build, max_rate=max_rate, wait=False):
+            logging.debug("{} image {} is being imported already".format(kind, build["id"]))
+        if stopping:
+            return
+
+def start(args):
+    cfg = tools.config.load(args)
+    if cfg["waydroid"]["prestage"] != "True":
+        return
+    interval = int(cfg["waydroid"]["prestage_interval"])
+
+    # Work on a copy, upgrader.get_config() sets up channel state in args
+    stager_args = copy.copy(args)
+    tools.actions.upgrader.get_config(stager_args)
+    if stager_args.images_path in tools.config.defaults["preinstalled_images_paths"]:
+        logging.debug("Pre-installed images are used, not staging upgrades")
+        return
+
+    def service_thread():
+        set_idle_priority()
+        while not stopping:
+            try:
+                stage(stager_args)
+            except Exception as e:
+                logging.debug("Background upgrade staging failed: {}".format(e))
+            wakeup.wait(interval)
+
+    global stopping
+    stopping = False
+    wakeup.clear()
+    args.upgrade_stager = threading.Thread(target=service_thread)
+    args.upgrade_stager.daemon = True
+    args.upgrade_stager.start()
+
+def stop(args):
+    global stopping
+    stopping = True
+    wakeup.set()
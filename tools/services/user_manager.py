@@ -4,9 +4,11 @@ import logging
 import os
 import threading
 import tools.config
+import tools.helpers.ipc
 import tools.helpers.net
 from tools.interfaces import IUserMonitor
 from tools.interfaces import IPlatform
+import dbus
 
 stopping = False
 
@@ -83,6 +85,10 @@ NoDisplay={str(hide).lower()}
                 makeDesktopFile(app)
             multiwin = platformService.getprop("persist.waydroid.multi_windows", "false")
             makeWaydroidDesktopFile(multiwin == "true")
+        try:
+            tools.helpers.ipc.DBusContainerService().NotifyBootCompleted()
+        except dbus.DBusException:
+            pass
         if unlocked_cb:
             unlocked_cb()
 